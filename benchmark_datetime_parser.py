@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import random
+import time
+from datetime import date
+from services.datetime_parser import parse_datetime, cache_info, clear_cache
+
+TODAY = date(2025, 12, 20)
+
+def benchmark(rounds=20000, seed=11):
+    rng = random.Random(seed)
+    messages = [f"{rng.randint(1, 12)}/{rng.randint(1, 28)} 下午{rng.randint(1, 7)}點半" for _ in range(200)]
+    messages += ["明天下午2點", "下週三", "14:00", "2點半", "我想預約日式美睫"]
+
+    clear_cache()
+    started = time.perf_counter()
+    for index in range(rounds):
+        clear_cache()
+        parse_datetime(messages[index % len(messages)], today=TODAY)
+    uncached_us = (time.perf_counter() - started) / rounds * 1e6
+
+    clear_cache()
+    started = time.perf_counter()
+    for index in range(rounds):
+        parse_datetime(messages[index % len(messages)], today=TODAY)
+    cached_us = (time.perf_counter() - started) / rounds * 1e6
+
+    print(f"未快取：{uncached_us:.2f} µs/則，含快取：{cached_us:.2f} µs/則，快取統計：{cache_info()}")
+
+if __name__ == "__main__":
+    benchmark()
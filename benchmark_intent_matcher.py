@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import random
+import time
+from services.intent_matcher import IntentMatcher
+
+# 實際訊息樣本
+MESSAGES = [
+    "你好",
+    "我想預約日式美睫",
+    "請問霧眉的價格是多少？",
+    "接完睫毛後可以洗臉嗎",
+    "5/20 下午2點半",
+    "取消預約",
+    "我的預約狀態",
+    "請問多久洗頭比較好",
+    "想問髮際線的療程要多久時間，術後需要注意什麼",
+    "謝謝你～下次見",
+]
+
+# 用來產生合成關鍵字的字元
+CHARS = "美睫霧眉唇髮際線保養護理課程洗頭價格預約時間取消服務項目介紹敏感痘斑療程術後"
+
+def build_tables(keyword_count, seed=42):
+    """產生指定數量關鍵字的合成關鍵字表（10 個主題平均分配）"""
+    rng = random.Random(seed)
+    tables = {'knowledge': {}}
+    for index in range(keyword_count):
+        keyword = ''.join(rng.choice(CHARS) for _ in range(rng.randint(2, 4)))
+        tables['knowledge'].setdefault(f"topic{index % 10}", []).append(keyword)
+    return tables
+
+def naive_match(tables, text):
+    """原本的作法：逐一檢查每個關鍵字是否出現在訊息中"""
+    lowered = text.lower()
+    hits = {}
+    for category, labels in tables.items():
+        for label, keywords in labels.items():
+            for keyword in keywords:
+                if keyword in lowered:
+                    hits.setdefault(category, set()).add(label)
+                    break
+    return hits
+
+def time_per_message(func, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in MESSAGES:
+            func(message)
+    return (time.perf_counter() - started) / (rounds * len(MESSAGES)) * 1e6
+
+def main():
+    rounds = 200
+    print(f"{'關鍵字數':>8} {'逐一比對(µs)':>14} {'自動機(µs)':>12} {'建表(ms)':>10}")
+    for keyword_count in (25, 100, 500, 2000, 10000):
+        tables = build_tables(keyword_count)
+        started = time.perf_counter()
+        matcher = IntentMatcher(tables)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        # 確認兩種作法結果一致
+        for message in MESSAGES:
+            expected = naive_match(tables, message)
+            result = matcher.match(message)
+            assert set(expected.get('knowledge', ())) == set(result.labels('knowledge')), message
+
+        naive_us = time_per_message(lambda message: naive_match(tables, message), rounds)
+        automaton_us = time_per_message(matcher.match, rounds)
+        print(f"{keyword_count:>8} {naive_us:>14.2f} {automaton_us:>12.2f} {build_ms:>10.2f}")
+
+if __name__ == "__main__":
+    main()
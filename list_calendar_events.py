@@ -90,6 +90,19 @@ def list_calendar_events():
         except Exception as e:
             print(f"獲取事件列表失敗: {str(e)}")
             
+        # 若有設定本地 SQLite 副本，直接以索引查詢列出事件
+        if calendar_service.mirror is not None:
+            print("\n從本地日曆副本列出未來30天內的事件:")
+            try:
+                calendar_service.sync_mirror()
+                start = datetime.now()
+                local_events = calendar_service.mirror.list_events(start, start + timedelta(days=30))
+                print(f"找到 {len(local_events)} 個事件:")
+                for event in local_events:
+                    print(f"- {event['summary']} (ID: {event['id']}) 開始時間: {event['start']} 結束時間: {event['end']}")
+            except Exception as e:
+                print(f"從本地副本列出事件失敗: {str(e)}")
+        
         # 測試連接
         print("\n測試 Google Calendar API 連接:")
         connection_success = calendar_service.test_connection()
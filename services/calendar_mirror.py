@@ -0,0 +1,91 @@
+import threading
+from datetime import datetime, timedelta
+
+class CalendarMirror:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self._by_date = {}
+        self.sync_token = None
+
+    @staticmethod
+    def _dates_of(start, end):
+        """事件涵蓋的所有日期（零長度事件算在開始當天）"""
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        last = max(end - timedelta(microseconds=1), start)
+        while day <= last:
+            yield day.strftime("%Y-%m-%d")
+            day += timedelta(days=1)
+
+    def _remove_locked(self, event_id):
+        record = self._events.pop(event_id, None)
+        if record is None:
+            return
+        for date in self._dates_of(record[0], record[1]):
+            events_on_date = self._by_date.get(date)
+            if events_on_date:
+                events_on_date.pop(event_id, None)
+                if not events_on_date:
+                    del self._by_date[date]
+
+    def _upsert_locked(self, event_id, record):
+        self._remove_locked(event_id)
+        start, end = record[0], record[1]
+        self._events[event_id] = record
+        for date in self._dates_of(start, end):
+            self._by_date.setdefault(date, {})[event_id] = (start, end)
+
+    def replace_all(self, events, sync_token):
+        """以完整同步的結果取代鏡像內容；events 為 {event_id: (start, end, summary)}"""
+        with self._lock:
+            self._events = {}
+            self._by_date = {}
+            for event_id, record in events.items():
+                self._upsert_locked(event_id, record)
+            self.sync_token = sync_token
+
+    def apply_changes(self, upserts, deletions, sync_token=None):
+        """套用增量同步的變更"""
+        with self._lock:
+            for event_id in deletions:
+                self._remove_locked(event_id)
+            for event_id, record in upserts.items():
+                self._upsert_locked(event_id, record)
+            if sync_token:
+                self.sync_token = sync_token
+
+    def prune_before(self, cutoff):
+        """移除在 cutoff 之前就已結束的事件（同步範圍之外），回傳移除的數量"""
+        with self._lock:
+            expired = [event_id for event_id, record in self._events.items() if record[1] < cutoff]
+            for event_id in expired:
+                self._remove_locked(event_id)
+        return len(expired)
+
+    def busy_on(self, date):
+        """回傳與指定日期重疊的事件區間（裁切到當天範圍內）"""
+        with self._lock:
+            intervals = list(self._by_date.get(date, {}).values())
+        if not intervals:
+            return []
+        day_start = datetime.strptime(date, "%Y-%m-%d")
+        day_end = day_start + timedelta(days=1)
+        return [(max(start, day_start), min(end, day_end)) for start, end in intervals]
+
+    def list_events(self, start, end):
+        """列出與 [start, end) 重疊的事件，依開始時間排序"""
+        with self._lock:
+            events = [
+                {'id': event_id, 'start': record[0], 'end': record[1], 'summary': record[2]}
+                for event_id, record in self._events.items()
+                if record[0] < end and record[1] > start
+            ]
+        return sorted(events, key=lambda event: event['start'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'events': len(self._events),
+                'dates': len(self._by_date),
+                'has_sync_token': bool(self.sync_token)
+            }
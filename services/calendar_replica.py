@@ -0,0 +1,148 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+class SqliteCalendarMirror:
+    def __init__(self, path, calendar_id):
+        self.path = path
+        self.calendar_id = calendar_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                start_ts TEXT NOT NULL,
+                end_ts TEXT NOT NULL,
+                summary TEXT,
+                PRIMARY KEY (calendar_id, event_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_events_time ON events (calendar_id, start_ts, end_ts);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                calendar_id TEXT PRIMARY KEY,
+                sync_token TEXT
+            );
+        """)
+        self._conn.commit()
+        # 副本中最長的事件長度，查詢時以此限制開始時間的下界，不必掃描所有過去的事件
+        with self._lock:
+            self._max_duration = self._longest_event_locked()
+
+    def _longest_event_locked(self):
+        row = self._conn.execute(
+            "SELECT MAX((julianday(end_ts) - julianday(start_ts)) * 86400) FROM events WHERE calendar_id = ?",
+            (self.calendar_id,)
+        ).fetchone()
+        return timedelta(seconds=max(0, round(row[0] or 0)))
+
+    @staticmethod
+    def _longest_of(events):
+        return max((record[1] - record[0] for record in events.values()), default=timedelta(0))
+
+    @property
+    def sync_token(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sync_token FROM sync_state WHERE calendar_id = ?", (self.calendar_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _rows(self, events):
+        return [
+            (self.calendar_id, event_id, record[0].strftime(TIME_FORMAT), record[1].strftime(TIME_FORMAT), record[2])
+            for event_id, record in events.items()
+        ]
+
+    def _save_token_locked(self, sync_token):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sync_state (calendar_id, sync_token) VALUES (?, ?)",
+            (self.calendar_id, sync_token)
+        )
+
+    def replace_all(self, events, sync_token):
+        """以完整同步的結果取代副本內容；events 為 {event_id: (start, end, summary)}"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM events WHERE calendar_id = ?", (self.calendar_id,))
+            self._conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)", self._rows(events))
+            self._save_token_locked(sync_token)
+            self._max_duration = self._longest_of(events)
+
+    def apply_changes(self, upserts, deletions, sync_token=None):
+        """在同一個交易中套用增量同步的變更"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM events WHERE calendar_id = ? AND event_id = ?",
+                [(self.calendar_id, event_id) for event_id in deletions]
+            )
+            self._conn.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)", self._rows(upserts))
+            if sync_token:
+                self._save_token_locked(sync_token)
+            self._max_duration = max(self._max_duration, self._longest_of(upserts))
+
+    def prune_before(self, cutoff):
+        """刪除在 cutoff 之前就已結束的事件（同步範圍之外），回傳刪除的數量"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM events WHERE calendar_id = ? AND end_ts < ?",
+                (self.calendar_id, cutoff.strftime(TIME_FORMAT))
+            )
+            if cursor.rowcount:
+                self._max_duration = self._longest_event_locked()
+        return cursor.rowcount
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _window_params(self, start, end):
+        """重疊查詢的參數：開始時間限制在 [start - 最長事件長度, end)，索引只掃描這個範圍"""
+        return (
+            self.calendar_id,
+            (start - self._max_duration).strftime(TIME_FORMAT),
+            end.strftime(TIME_FORMAT),
+            start.strftime(TIME_FORMAT)
+        )
+
+    def busy_between(self, start, end):
+        """以索引查詢與 [start, end) 重疊的事件區間"""
+        rows = self._query(
+            "SELECT start_ts, end_ts FROM events "
+            "WHERE calendar_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? ORDER BY start_ts",
+            self._window_params(start, end)
+        )
+        return [(datetime.strptime(s, TIME_FORMAT), datetime.strptime(e, TIME_FORMAT)) for s, e in rows]
+
+    def busy_on(self, date):
+        """回傳與指定日期重疊的事件區間（裁切到當天範圍內）"""
+        day_start = datetime.strptime(date, "%Y-%m-%d")
+        day_end = day_start + timedelta(days=1)
+        return [(max(start, day_start), min(end, day_end)) for start, end in self.busy_between(day_start, day_end)]
+
+    def list_events(self, start, end):
+        """列出與 [start, end) 重疊的事件，依開始時間排序"""
+        rows = self._query(
+            "SELECT event_id, start_ts, end_ts, summary FROM events "
+            "WHERE calendar_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? ORDER BY start_ts",
+            self._window_params(start, end)
+        )
+        return [
+            {
+                'id': event_id,
+                'start': datetime.strptime(start_ts, TIME_FORMAT),
+                'end': datetime.strptime(end_ts, TIME_FORMAT),
+                'summary': summary
+            }
+            for event_id, start_ts, end_ts, summary in rows
+        ]
+
+    def stats(self):
+        event_count = self._query("SELECT COUNT(*) FROM events WHERE calendar_id = ?", (self.calendar_id,))[0][0]
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'events': event_count,
+            'has_sync_token': bool(self.sync_token)
+        }
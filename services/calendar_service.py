@@ -1,13 +1,69 @@
 import os
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from datetime import datetime, timedelta
 import logging
 import json
+import hashlib
+import threading
+import time
+import uuid
+from services.ttl_cache import TTLCache
+from services.calendar_mirror import CalendarMirror
+from services.calendar_replica import SqliteCalendarMirror
+from services.slot_hold import InMemorySlotHoldStore
+from services.slot_grid import TAIPEI_TZ, BUSINESS_CLOSE_HOUR, SLOT_MINUTES, DaySlotGrid
 
 # 設置日誌
 logger = logging.getLogger(__name__)
 
+def booking_event_id(user_id, service, start_time):
+    """由用戶、服務與開始時間產生固定的事件 ID，重送同一筆預約時不會重複建立"""
+    digest = hashlib.sha1(f"{user_id}|{service}|{start_time.isoformat()}".encode('utf-8')).hexdigest()
+    # Google Calendar 事件 ID 只接受 base32hex 字元（0-9、a-v），十六進位字串符合此限制
+    return f"bk{digest}"
+
+def _to_local(dt_str):
+    """將 Google Calendar 的 RFC3339 時間轉為台北時間（不含時區資訊）"""
+    dt = datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(TAIPEI_TZ).replace(tzinfo=None)
+    return dt
+
+def _event_interval(event):
+    """取得事件的台北時間區間，全天事件或無法解析時回傳 None"""
+    start = event.get('start', {}).get('dateTime')
+    if not start:
+        return None
+    end = event.get('end', {}).get('dateTime')
+    start_dt = _to_local(start)
+    end_dt = _to_local(end) if end else start_dt + timedelta(minutes=SLOT_MINUTES)
+    return start_dt, end_dt
+
+def _event_record(event):
+    """本地鏡像儲存的事件內容 (開始, 結束, 標題)，全天事件回傳 None"""
+    interval = _event_interval(event)
+    if not interval:
+        return None
+    return interval[0], interval[1], event.get('summary', '')
+
+def merge_intervals(intervals):
+    """排序並合併重疊或相鄰的忙碌區間"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def _day_bounds(date):
+    """回傳指定日期（台北時間）整天的 RFC3339 起訖時間"""
+    day_start = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=TAIPEI_TZ)
+    return day_start.isoformat(), (day_start + timedelta(days=1)).isoformat()
+
 class GoogleCalendarService:
     def __init__(self):
         SCOPES = ['https://www.googleapis.com/auth/calendar']
@@ -43,16 +99,74 @@ class GoogleCalendarService:
             logger.info(f"使用日曆ID: {self.calendar_id}")
             print(f"[LOG] 使用日曆ID: {self.calendar_id}")
             
+            # 初始化後立即檢查日曆信息（指定日曆不可用時會回退到主日曆）
+            self._check_calendar_info()
+            
+            # 日曆 ID 確定後才建立本地鏡像與快取，避免副本綁定到回退前的日曆
+            self._init_availability_state()
+            
             logger.info("Google Calendar 服務初始化成功")
             print("[LOG] Google Calendar 服務初始化成功")
-            
-            # 初始化後立即檢查日曆信息
-            self._check_calendar_info()
         except Exception as e:
             logger.error(f"Google Calendar 服務初始化失敗: {str(e)}")
             print(f"[ERROR] Google Calendar 服務初始化失敗: {str(e)}")
             raise
 
+    def _init_availability_state(self):
+        """初始化可用時段查詢所需的本地狀態"""
+        # 依日期快取已預約的時段，預約寫入時立即失效
+        self.busy_cache = TTLCache(max_size=366, ttl=int(os.getenv('CALENDAR_CACHE_TTL', 60)))
+        self._cache_stats_lock = threading.Lock()
+        self._cache_invalidations = 0
+        self._served_age_total = 0.0
+        self._served_age_max = 0.0
+        self._served_count = 0
+        # 快取未命中時一次預取多天的忙碌時段（freebusy 查詢），1 表示只查當天
+        self.prefetch_days = max(1, int(os.getenv('CALENDAR_PREFETCH_DAYS', 7)))
+        # Google API 調用次數（總計與目前執行緒各自累計）
+        self._api_calls = {}
+        self._thread_local = threading.local()
+        # 本地日曆鏡像：以 syncToken 增量同步，推播通知到達時標記為需要同步
+        self.replica_path = os.getenv('CALENDAR_REPLICA_PATH')
+        self.mirror = self._create_mirror()
+        self.mirror_max_age = int(os.getenv('CALENDAR_MIRROR_MAX_AGE', 300))
+        self._mirror_lock = threading.Lock()
+        self._mirror_dirty = True
+        self._mirror_synced_at = None
+        self._mirror_full_syncs = 0
+        self._mirror_incremental_syncs = 0
+        self._watch_channel = None
+        # 確認預約前的暫時保留，避免兩位客人同時被告知同一時段可預約
+        self.slot_holds = InMemorySlotHoldStore()
+        self.slot_hold_ttl = int(os.getenv('SLOT_HOLD_TTL', 300))
+
+    def _create_mirror(self):
+        """依設定建立本地鏡像：有 CALENDAR_REPLICA_PATH 時使用 SQLite 副本，重啟後仍保留"""
+        if self.replica_path:
+            return SqliteCalendarMirror(self.replica_path, self.calendar_id)
+        if os.getenv('CALENDAR_SYNC_MODE') == 'mirror':
+            return CalendarMirror()
+        return None
+
+    def _count_api_call(self, name):
+        with self._cache_stats_lock:
+            self._api_calls[name] = self._api_calls.get(name, 0) + 1
+        self._thread_local.calls = getattr(self._thread_local, 'calls', 0) + 1
+
+    def reset_thread_api_calls(self):
+        """重設目前執行緒的 API 調用計數，回傳重設前的次數"""
+        calls = getattr(self._thread_local, 'calls', 0)
+        self._thread_local.calls = 0
+        return calls
+
+    def thread_api_calls(self):
+        """目前執行緒自上次重設後的 Google API 調用次數"""
+        return getattr(self._thread_local, 'calls', 0)
+
+    def api_call_counts(self):
+        with self._cache_stats_lock:
+            return dict(self._api_calls)
+
     def get_available_slots(self, days_ahead=7):
         """獲取未來幾天內的可用時段"""
         now = datetime.utcnow()
@@ -84,8 +198,8 @@ class GoogleCalendarService:
             
         return available_slots
 
-    def create_booking(self, start_time, end_time, user_info, service):
-        """創建預約"""
+    def create_booking(self, start_time, end_time, user_info, service, user_id=None):
+        """創建預約，提供 user_id 時使用固定事件 ID，重試不會產生重複預約"""
         try:
             # 確保時間格式正確，帶有時區信息
             start_iso = start_time.isoformat()
@@ -114,6 +228,8 @@ class GoogleCalendarService:
                     ],
                 },
             }
+            if user_id:
+                event['id'] = booking_event_id(user_id, service, start_time)
             
             logger.info(f"預約事件詳情: {json.dumps(event, ensure_ascii=False)}")
             print(f"[LOG] 預約事件詳情: {json.dumps(event, ensure_ascii=False)}")
@@ -136,12 +252,18 @@ class GoogleCalendarService:
                 # 創建請求並執行
                 logger.info("開始構建API請求")
                 print("[LOG] 開始構建API請求")
+                self._count_api_call('events.insert')
                 request = self.service.events().insert(calendarId=self.calendar_id, body=event)
                 logger.info("API請求構建完成，準備執行")
                 print("[LOG] API請求構建完成，準備執行")
                 
-                # 執行API請求
-                created_event = request.execute()
+                # 執行API請求；相同 ID 已存在（409）代表先前的請求已成功建立
+                try:
+                    created_event = request.execute()
+                except HttpError as http_error:
+                    if http_error.resp.status != 409 or 'id' not in event:
+                        raise
+                    created_event = self._recover_existing_booking(event)
                 logger.info(f"事件創建成功: {json.dumps(created_event, ensure_ascii=False)}")
                 print(f"[LOG] 事件創建成功: {json.dumps(created_event, ensure_ascii=False)}")
                 
@@ -157,6 +279,13 @@ class GoogleCalendarService:
                 logger.info(f"成功建立預約 - ID: {event_id}, 連結: {event_link}")
                 print(f"[LOG] 成功建立預約 - ID: {event_id}, 連結: {event_link}")
                 
+                # 該日期的可用時段已改變，清除快取並寫入本地鏡像
+                if self.mirror is not None:
+                    self.mirror.apply_changes({event_id: (start_time, end_time, created_event.get('summary', ''))}, [])
+                self.invalidate_date(start_time.strftime("%Y-%m-%d"))
+                if end_time.date() != start_time.date():
+                    self.invalidate_date(end_time.strftime("%Y-%m-%d"))
+                
                 # 返回成功結果
                 return {
                     'id': event_id,
@@ -192,6 +321,25 @@ class GoogleCalendarService:
             print(f"[ERROR] 創建預約過程中發生錯誤: {error_detail}")
             raise Exception(f'創建預約失敗：{error_detail}')
     
+    def _recover_existing_booking(self, event):
+        """處理固定 ID 的重複建立：取回既有事件，若已被取消則重新啟用"""
+        event_id = event['id']
+        logger.info(f"事件 {event_id} 已存在，視為重複送出的預約")
+        print(f"[LOG] 事件 {event_id} 已存在，視為重複送出的預約")
+        self._count_api_call('events.get')
+        existing = self.service.events().get(calendarId=self.calendar_id, eventId=event_id).execute()
+        if existing.get('status') != 'cancelled':
+            return existing
+        
+        logger.info(f"事件 {event_id} 先前已取消，重新啟用")
+        print(f"[LOG] 事件 {event_id} 先前已取消，重新啟用")
+        self._count_api_call('events.update')
+        return self.service.events().update(
+            calendarId=self.calendar_id,
+            eventId=event_id,
+            body=dict(event, status='confirmed')
+        ).execute()
+    
     def _check_credentials(self):
         """檢查憑證狀態"""
         try:
@@ -235,6 +383,7 @@ class GoogleCalendarService:
         try:
             logger.info(f"調用 Google Calendar API 獲取事件 {event_id}")
             print(f"[LOG] 調用 Google Calendar API 獲取事件 {event_id}")
+            self._count_api_call('events.get')
             event = self.service.events().get(calendarId=self.calendar_id, eventId=event_id).execute()
             
             if event and event.get('id') == event_id:
@@ -254,75 +403,328 @@ class GoogleCalendarService:
     def get_event_by_id(self, event_id):
         """根據 ID 獲取事件詳情"""
         try:
+            self._count_api_call('events.get')
             return self.service.events().get(calendarId=self.calendar_id, eventId=event_id).execute()
         except Exception as e:
             logger.error(f"獲取行事曆項目失敗: {str(e)}")
             return None
 
-    def get_available_slots_by_date(self, date):
-        """查詢指定日期的可用時段（10:00-20:00，每30分鐘）"""
+    def invalidate_date(self, date):
+        """清除指定日期的已預約時段快取"""
+        if self.busy_cache.pop(date) is not None:
+            with self._cache_stats_lock:
+                self._cache_invalidations += 1
+            logger.info(f"清除 {date} 的時段快取")
+
+    def _fetch_busy_intervals(self, date):
+        """向 Google Calendar 查詢指定日期（台北時間）的已預約區間"""
+        timeMin, timeMax = _day_bounds(date)
+        logger.info(f"查詢時間範圍: {timeMin} 到 {timeMax}")
+        print(f"[LOG] 查詢時間範圍: {timeMin} 到 {timeMax}")
+        
+        logger.info(f"調用 Google Calendar API 列出事件")
+        print(f"[LOG] 調用 Google Calendar API 列出事件")
+        self._count_api_call('events.list')
+        events_result = self.service.events().list(
+            calendarId=self.calendar_id,
+            timeMin=timeMin,
+            timeMax=timeMax,
+            singleEvents=True,
+            orderBy='startTime'
+        ).execute()
+        
+        items = events_result.get('items', [])
+        print(f"[LOG] Google Calendar API 列出事件成功，找到 {len(items)} 個事件")
+        
+        intervals = []
+        for event in items:
+            try:
+                interval = _event_interval(event)
+                if interval:
+                    intervals.append(interval)
+                    logger.info(f"找到已預約時段: {interval[0]} - {interval[1]}")
+            except Exception as time_error:
+                logger.error(f"解析事件時間失敗: {str(time_error)}, 原始時間字符串: {event.get('start')}")
+                print(f"[ERROR] 解析事件時間失敗: {str(time_error)}, 原始時間字符串: {event.get('start')}")
+        return intervals
+
+    def prefetch_busy_range(self, start_date, days):
+        """以一次 freebusy 查詢取得多天的忙碌區間並依日期寫入快取"""
+        first_day = datetime.strptime(start_date, "%Y-%m-%d")
+        timeMin, _ = _day_bounds(start_date)
+        timeMax, _ = _day_bounds((first_day + timedelta(days=days)).strftime("%Y-%m-%d"))
+        logger.info(f"預取 {start_date} 起 {days} 天的忙碌時段: {timeMin} 到 {timeMax}")
+        print(f"[LOG] 預取 {start_date} 起 {days} 天的忙碌時段")
+        
+        self._count_api_call('freebusy.query')
+        result = self.service.freebusy().query(body={
+            'timeMin': timeMin,
+            'timeMax': timeMax,
+            'timeZone': 'Asia/Taipei',
+            'items': [{'id': self.calendar_id}]
+        }).execute()
+        
+        calendar_result = result.get('calendars', {}).get(self.calendar_id, {})
+        if calendar_result.get('errors'):
+            raise Exception(f"freebusy 查詢失敗: {calendar_result['errors']}")
+        
+        # 依日期分組，跨日的區間拆到各自的日期
+        by_date = {(first_day + timedelta(days=i)).strftime("%Y-%m-%d"): [] for i in range(days)}
+        for busy in calendar_result.get('busy', []):
+            start_dt = _to_local(busy['start'])
+            end_dt = _to_local(busy['end'])
+            day = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+            while day < end_dt:
+                next_day = day + timedelta(days=1)
+                date_key = day.strftime("%Y-%m-%d")
+                if date_key in by_date:
+                    by_date[date_key].append((max(start_dt, day), min(end_dt, next_day)))
+                day = next_day
+        
+        fetched_at = time.monotonic()
+        for date_key, intervals in by_date.items():
+            self.busy_cache.set(date_key, (merge_intervals(intervals), fetched_at))
+        return by_date
+
+    def _list_all_pages(self, **params):
+        """分頁取得事件列表，回傳 (事件列表, nextSyncToken)"""
+        items = []
+        page_token = None
+        while True:
+            self._count_api_call('events.list')
+            result = self.service.events().list(
+                calendarId=self.calendar_id,
+                singleEvents=True,
+                maxResults=2500,
+                pageToken=page_token,
+                **params
+            ).execute()
+            items.extend(result.get('items', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return items, result.get('nextSyncToken')
+
+    @staticmethod
+    def _sync_window_start():
+        """鏡像只保留一天前之後的事件"""
+        return datetime.now(TAIPEI_TZ) - timedelta(days=1)
+
+    def _full_sync(self):
+        items, sync_token = self._list_all_pages(timeMin=self._sync_window_start().isoformat())
+        events = {}
+        for event in items:
+            if event.get('status') == 'cancelled':
+                continue
+            record = _event_record(event)
+            if record:
+                events[event['id']] = record
+        self.mirror.replace_all(events, sync_token)
+        self._mirror_full_syncs += 1
+        logger.info(f"日曆鏡像完整同步完成，共 {len(events)} 個事件")
+        print(f"[LOG] 日曆鏡像完整同步完成，共 {len(events)} 個事件")
+
+    def _incremental_sync(self):
+        items, sync_token = self._list_all_pages(syncToken=self.mirror.sync_token)
+        upserts = {}
+        deletions = []
+        for event in items:
+            record = _event_record(event) if event.get('status') != 'cancelled' else None
+            if record:
+                upserts[event['id']] = record
+            else:
+                deletions.append(event['id'])
+        self.mirror.apply_changes(upserts, deletions, sync_token)
+        # 增量同步只會帶回變更，已結束的舊事件要自行移除，鏡像才不會隨歷史預約持續變大
+        pruned = self.mirror.prune_before(self._sync_window_start().replace(tzinfo=None))
+        self._mirror_incremental_syncs += 1
+        logger.info(f"日曆鏡像增量同步完成，更新 {len(upserts)} 個、移除 {len(deletions)} 個事件，清除 {pruned} 個過期事件")
+
+    def sync_mirror(self, force_full=False, only_if_stale=False):
+        """同步本地日曆鏡像：有 syncToken 時只取變更，token 失效 (410) 時改為完整同步；
+        only_if_stale=True 時若取得鎖後鏡像已是最新（其他執行緒剛同步完成）則不再同步"""
+        if self.mirror is None:
+            return False
+        with self._mirror_lock:
+            if only_if_stale and not self._mirror_needs_sync():
+                return False
+            # 在同步前清除標記，同步期間收到的通知會在下次讀取時再同步一次
+            self._mirror_dirty = False
+            try:
+                if force_full or not self.mirror.sync_token:
+                    self._full_sync()
+                else:
+                    try:
+                        self._incremental_sync()
+                    except HttpError as e:
+                        if e.resp.status != 410:
+                            raise
+                        logger.warning("syncToken 已失效，改為完整同步")
+                        print("[WARNING] syncToken 已失效，改為完整同步")
+                        self._full_sync()
+                self._mirror_synced_at = time.monotonic()
+                return True
+            except Exception:
+                self._mirror_dirty = True
+                raise
+
+    def mark_mirror_dirty(self):
+        """收到日曆變更通知時呼叫，下次讀取前會先同步"""
+        self._mirror_dirty = True
+
+    def _mirror_needs_sync(self):
+        # 沒有推播頻道時無法得知變更，改以與快取相同的間隔輪詢增量同步
+        max_age = self.mirror_max_age if self._watch_channel else min(self.mirror_max_age, self.busy_cache.ttl)
+        stale = self._mirror_synced_at is None or time.monotonic() - self._mirror_synced_at > max_age
+        return self._mirror_dirty or stale
+
+    def _ensure_mirror_fresh(self):
+        self._renew_watch_channel_if_needed()
+        if self._mirror_needs_sync():
+            # 同時發現鏡像過期的讀取者只有第一個會真的同步，其他人取得鎖後直接使用結果
+            self.sync_mirror(only_if_stale=True)
+
+    def start_watch_channel(self, address, token=None, ttl_seconds=604800):
+        """向 Google Calendar 註冊推播通知頻道，日曆有變更時會呼叫 address"""
+        body = {
+            'id': str(uuid.uuid4()),
+            'type': 'web_hook',
+            'address': address,
+            'params': {'ttl': str(ttl_seconds)}
+        }
+        if token:
+            body['token'] = token
+        self._count_api_call('events.watch')
+        channel = self.service.events().watch(calendarId=self.calendar_id, body=body).execute()
+        self._watch_channel = {
+            'id': channel.get('id'),
+            'resource_id': channel.get('resourceId'),
+            'expiration': int(channel.get('expiration', 0)) / 1000,
+            'address': address,
+            'token': token,
+            'ttl_seconds': ttl_seconds
+        }
+        logger.info(f"已註冊日曆推播通知頻道: {channel.get('id')}")
+        print(f"[LOG] 已註冊日曆推播通知頻道: {channel.get('id')}")
+        return self._watch_channel
+
+    def stop_watch_channel(self):
+        """停止目前的推播通知頻道"""
+        channel = self._watch_channel
+        if not channel:
+            return
+        self._watch_channel = None
         try:
-            date_start = datetime.strptime(date, "%Y-%m-%d").replace(hour=10, minute=0, second=0, microsecond=0)
-            date_end = date_start.replace(hour=20, minute=0)
-            
-            # 注意：將時區信息加入到ISO格式字符串中，使用RFC3339格式
-            timeMin = date_start.strftime("%Y-%m-%dT%H:%M:%S")
-            timeMax = date_end.strftime("%Y-%m-%dT%H:%M:%S")
-            
-            # 確保添加Z表示UTC時間
-            timeMin = timeMin + 'Z'
-            timeMax = timeMax + 'Z'
-            
-            logger.info(f"查詢時間範圍: {timeMin} 到 {timeMax}")
-            print(f"[LOG] 查詢時間範圍: {timeMin} 到 {timeMax}")
-            
+            self.service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resource_id']}).execute()
+        except Exception as e:
+            logger.error(f"停止日曆推播通知頻道失敗: {str(e)}")
+
+    def _renew_watch_channel_if_needed(self):
+        channel = self._watch_channel
+        if not channel or not channel['expiration'] or channel['expiration'] - time.time() > 3600:
+            return
+        try:
+            self.stop_watch_channel()
+            self.start_watch_channel(channel['address'], channel['token'], channel['ttl_seconds'])
+        except Exception as e:
+            logger.error(f"更新日曆推播通知頻道失敗: {str(e)}")
+            print(f"[ERROR] 更新日曆推播通知頻道失敗: {str(e)}")
+
+    def handle_push_notification(self, headers):
+        """處理 Google Calendar 推播通知，回傳通知是否有效"""
+        channel = self._watch_channel
+        if not channel or headers.get('X-Goog-Channel-ID') != channel['id']:
+            logger.warning(f"收到未知頻道的日曆通知: {headers.get('X-Goog-Channel-ID')}")
+            return False
+        if channel['token'] and headers.get('X-Goog-Channel-Token') != channel['token']:
+            logger.warning("日曆通知的頻道 token 不符")
+            return False
+        state = headers.get('X-Goog-Resource-State')
+        logger.info(f"收到日曆推播通知: {state}")
+        if state != 'sync':
+            self.mark_mirror_dirty()
+        return True
+
+    def get_busy_intervals(self, date):
+        """取得指定日期已合併、排序的忙碌區間，優先使用本地鏡像或快取"""
+        if self.mirror is not None:
             try:
-                logger.info(f"調用 Google Calendar API 列出事件")
-                print(f"[LOG] 調用 Google Calendar API 列出事件")
-                
-                # 使用標準RFC3339格式
-                events_result = self.service.events().list(
-                    calendarId=self.calendar_id,
-                    timeMin=timeMin,
-                    timeMax=timeMax,
-                    singleEvents=True,
-                    orderBy='startTime'
-                ).execute()
-                
-                logger.info(f"Google Calendar API 返回結果: {json.dumps(events_result.get('items', []), ensure_ascii=False)}")
-                print(f"[LOG] Google Calendar API 列出事件成功，找到 {len(events_result.get('items', []))} 個事件")
-                
-                booked_slots = []
-                for event in events_result.get('items', []):
-                    start = event['start'].get('dateTime')
-                    if start:
-                        try:
-                            # 處理時區
-                            event_time = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                            # 轉換為當地時間格式的字符串，僅保留時分
-                            booked_time_str = event_time.strftime('%H:%M')
-                            booked_slots.append(booked_time_str)
-                            logger.info(f"找到已預約時段: {event_time} -> {booked_time_str}")
-                            print(f"[LOG] 找到已預約時段: {event_time} -> {booked_time_str}")
-                        except Exception as time_error:
-                            logger.error(f"解析事件時間失敗: {str(time_error)}, 原始時間字符串: {start}")
-                            print(f"[ERROR] 解析事件時間失敗: {str(time_error)}, 原始時間字符串: {start}")
-                
-                available_slots = []
-                current = date_start
-                while current < date_end:
-                    # 檢查當前時段是否已被預約
-                    current_time_str = current.strftime('%H:%M')
-                    if current_time_str not in booked_slots:
-                        available_slots.append(current_time_str)
-                    
-                    current += timedelta(minutes=30)
-                    
-                logger.info(f"可用時段數量: {len(available_slots)}")
-                print(f"[LOG] 可用時段數量: {len(available_slots)}")
-                
-                return available_slots
-                
+                self._ensure_mirror_fresh()
+                return merge_intervals(self.mirror.busy_on(date))
+            except Exception as e:
+                logger.error(f"日曆鏡像同步失敗，改用即時查詢: {str(e)}")
+                print(f"[ERROR] 日曆鏡像同步失敗，改用即時查詢: {str(e)}")
+        
+        cached = self.busy_cache.get(date)
+        if cached is not None:
+            intervals, fetched_at = cached
+            age = time.monotonic() - fetched_at
+            with self._cache_stats_lock:
+                self._served_count += 1
+                self._served_age_total += age
+                self._served_age_max = max(self._served_age_max, age)
+            logger.info(f"使用 {date} 的時段快取（{age:.1f} 秒前取得）")
+            return intervals
+        
+        if self.prefetch_days > 1:
+            try:
+                return self.prefetch_busy_range(date, self.prefetch_days)[date]
+            except Exception as e:
+                logger.error(f"預取忙碌時段失敗，改為查詢單日: {str(e)}")
+                print(f"[ERROR] 預取忙碌時段失敗，改為查詢單日: {str(e)}")
+        
+        intervals = merge_intervals(self._fetch_busy_intervals(date))
+        self.busy_cache.set(date, (intervals, time.monotonic()))
+        return intervals
+
+    def availability_cache_stats(self):
+        """回傳時段快取的命中率與資料新鮮度"""
+        stats = self.busy_cache.stats()
+        with self._cache_stats_lock:
+            stats['invalidations'] = self._cache_invalidations
+            stats['avg_served_age_seconds'] = round(self._served_age_total / self._served_count, 2) if self._served_count else 0.0
+            stats['max_served_age_seconds'] = round(self._served_age_max, 2)
+            stats['api_calls'] = dict(self._api_calls)
+        stats['slot_holds'] = self.slot_holds.stats()
+        if self.mirror is not None:
+            mirror_stats = self.mirror.stats()
+            mirror_stats['full_syncs'] = self._mirror_full_syncs
+            mirror_stats['incremental_syncs'] = self._mirror_incremental_syncs
+            mirror_stats['dirty'] = self._mirror_dirty
+            mirror_stats['seconds_since_sync'] = round(time.monotonic() - self._mirror_synced_at, 1) if self._mirror_synced_at else None
+            mirror_stats['watch_channel'] = bool(self._watch_channel)
+            stats['mirror'] = mirror_stats
+        return stats
+
+    def _slot_interval(self, date, time_str, duration_minutes):
+        start = datetime.strptime(f"{date} {time_str}", "%Y-%m-%d %H:%M")
+        return start, start + timedelta(minutes=duration_minutes)
+
+    def hold_slot(self, date, time_str, duration_minutes, owner):
+        """暫時保留時段給正在確認預約的用戶，已被他人保留時回傳 False"""
+        start, end = self._slot_interval(date, time_str, duration_minutes)
+        acquired = self.slot_holds.acquire(self.calendar_id, date, start, end, owner, self.slot_hold_ttl)
+        logger.info(f"保留時段 {date} {time_str} 給用戶 {owner}: {'成功' if acquired else '已被他人保留'}")
+        return acquired
+
+    def release_slot(self, date, owner):
+        """釋放用戶在指定日期保留的時段（完成預約、取消或改期時呼叫）"""
+        if not date:
+            return
+        try:
+            self.slot_holds.release(self.calendar_id, date, owner)
+        except Exception as e:
+            logger.error(f"釋放保留時段失敗: {str(e)}")
+
+    def is_slot_held(self, date, time_str, duration_minutes, owner):
+        """用戶是否仍持有該時段的保留（本地檢查，不呼叫 Google API）"""
+        start, end = self._slot_interval(date, time_str, duration_minutes)
+        return self.slot_holds.is_held_by(self.calendar_id, date, start, end, owner)
+
+    def day_grid(self, date, owner=None):
+        """取得指定日期的時段位元遮罩（10:00-20:00，每30分鐘一個位元），他人保留中的時段視為忙碌"""
+        try:
+            try:
+                busy = self.get_busy_intervals(date)
             except Exception as api_error:
                 logger.error(f"調用 Google Calendar API 列出事件失敗: {str(api_error)}")
                 print(f"[ERROR] 調用 Google Calendar API 列出事件失敗: {str(api_error)}")
@@ -330,22 +732,52 @@ class GoogleCalendarService:
                 # 在出錯時生成假時間槽以避免預約流程中斷
                 logger.warning("由於API錯誤，將返回所有可能的時間槽")
                 print("[WARNING] 由於API錯誤，將返回所有可能的時間槽")
-                
-                available_slots = []
-                current = date_start
-                while current < date_end:
-                    available_slots.append(current.strftime('%H:%M'))
-                    current += timedelta(minutes=30)
-                    
-                logger.info(f"生成默認時間槽: {available_slots}")
-                print(f"[LOG] 生成默認時間槽: {available_slots}")
-                return available_slots
+                busy = []
+            
+            try:
+                held = self.slot_holds.held_intervals(self.calendar_id, date, exclude_owner=owner)
+                if held:
+                    busy = busy + held
+            except Exception as hold_error:
+                logger.error(f"查詢保留時段失敗: {str(hold_error)}")
+            
+            grid = DaySlotGrid.from_busy(date, busy)
+            logger.info(f"{date} 空閒時段數量: {grid.count()}")
+            return grid
             
         except Exception as e:
             logger.error(f"獲取可用時段失敗: {str(e)}")
             print(f"[ERROR] 獲取可用時段失敗: {str(e)}")
-            # 返回空列表而不是拋出異常，避免中斷對話流程
-            return []
+            # 返回全部不可用的時段表而不是拋出異常，避免中斷對話流程
+            return DaySlotGrid(date, 0)
+
+    def available_starts(self, date, duration_minutes=SLOT_MINUTES, owner=None):
+        """查詢指定日期可容納整段服務時長的開始時段（'HH:MM' 清單）"""
+        grid = self.day_grid(date, owner=owner)
+        available_slots = grid.times(grid.starts_mask(duration_minutes))
+        logger.info(f"{date} 可容納 {duration_minutes} 分鐘的時段數量: {len(available_slots)}")
+        print(f"[LOG] {date} 可容納 {duration_minutes} 分鐘的時段數量: {len(available_slots)}")
+        return available_slots
+
+    def next_available_slot(self, from_date, duration_minutes=SLOT_MINUTES, days_ahead=30, owner=None):
+        """從指定日期開始往後找第一個可容納服務時長的時段（他人保留中的時段不算），回傳 (日期, 時間) 或 None"""
+        first_day = datetime.strptime(from_date, "%Y-%m-%d")
+        now = datetime.now(TAIPEI_TZ).replace(tzinfo=None)
+        for offset in range(days_ahead):
+            day = first_day + timedelta(days=offset)
+            # 已打烊的日期不需要查詢
+            if day.replace(hour=BUSINESS_CLOSE_HOUR) <= now:
+                continue
+            date = day.strftime("%Y-%m-%d")
+            grid = self.day_grid(date, owner=owner)
+            for time_str in grid.times(grid.starts_mask(duration_minutes)):
+                if datetime.strptime(f"{date} {time_str}", "%Y-%m-%d %H:%M") > now:
+                    return date, time_str
+        return None
+
+    def get_available_slots_by_date(self, date):
+        """查詢指定日期的可用時段（以單一時段長度計算）"""
+        return self.available_starts(date, SLOT_MINUTES)
 
     def test_connection(self):
         """測試Google Calendar API連接"""
@@ -493,6 +925,15 @@ class GoogleCalendarService:
             try:
                 calendar_info = self.service.calendars().get(calendarId=calendar_id).execute()
                 self.calendar_id = calendar_id
+                # 換日曆後舊的時段快取與鏡像不再適用
+                self.busy_cache.clear()
+                if self.mirror is not None:
+                    self.mirror = self._create_mirror()
+                    self._mirror_dirty = True
+                channel = self._watch_channel
+                if channel:
+                    self.stop_watch_channel()
+                    self.start_watch_channel(channel['address'], channel['token'], channel['ttl_seconds'])
                 logger.info(f"成功切換到日曆: {calendar_info.get('summary')} (ID: {calendar_id})")
                 print(f"[LOG] 成功切換到日曆: {calendar_info.get('summary')} (ID: {calendar_id})")
                 return True
@@ -1,11 +1,33 @@
 import os
-import openai
 from datetime import datetime
 import random
+import re
+import json
+import time
+import atexit
+import logging
+import threading
+import unicodedata
+from services.ttl_cache import TTLCache
+from services.latency_tracker import LatencyTracker
+from services.openai_client import OpenAIClient, CircuitOpenError, CancelToken
+from services.llm_routing import ModelRouter, count_message_tokens, count_tokens, fit_messages
+
+logger = logging.getLogger(__name__)
+
+# 正規化時去除的結尾標點與語助詞符號
+_TRAILING_PUNCTUATION = re.compile(r'[\s?？!！.。~～,，、…]+$')
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_message(message):
+    """正規化訊息文字作為快取鍵：全半形統一、忽略大小寫、空白與結尾標點"""
+    text = unicodedata.normalize('NFKC', message or '').casefold().strip()
+    text = _WHITESPACE.sub(' ', text)
+    return _TRAILING_PUNCTUATION.sub('', text)
 
 class ChatGPTService:
-    def __init__(self):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+    def __init__(self, cache_size=500, cache_ttl=86400, cache_path=None, request_timeout=30, reply_deadline=5, router=None, client=None):
+        self.client = client or OpenAIClient(api_key=os.getenv('OPENAI_API_KEY'), timeout=request_timeout)
         # 多組簡短有溫度的歡迎詞，明確品牌定位
         self.welcome_messages = [
             "🎉 歡迎來到 Fanny Beauty！很開心遇見你～請問怎麼稱呼你呢？😊",
@@ -24,29 +46,268 @@ class ChatGPTService:
             "8. 品牌名稱請固定用『Fanny Beauty』，不要用其他稱呼。\n"
             "9. 如果用戶還沒進入預約流程，可以在歡迎語或建檔流程結束時提示：『隨時輸入「預約」就可以開始預約流程唷！』"
         )
+        # OpenAI 異常或斷路器開啟時回覆的固定訊息，不把錯誤細節顯示給客人
+        self.fallback_message = "抱歉，小幫手現在有點忙碌，請稍後再試一次🙏 如需預約，隨時輸入「預約」就可以開始預約流程唷！"
+        # 超過 reply_deadline 仍未完成時先送出的暫時回覆
+        self.interim_message = "收到～我正在幫你整理資訊，請稍等一下，馬上回覆你喔！😊"
+        self.request_timeout = request_timeout
+        self.reply_deadline = reply_deadline
+        self._thread_local = threading.local()
+        self.router = router or ModelRouter()
+        self._model_stats = {}
+        # 常見問題回覆快取：以正規化訊息與非個人化的情境（是否為新用戶、對話狀態、模型路由）為鍵
+        self.response_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.cache_path = cache_path
+        self.llm_latency = LatencyTracker()
+        self._stats_lock = threading.Lock()
+        self._latency_saved = 0.0
+        self._uncacheable = 0
+        self._persist_lock = threading.Lock()
+        self._unsaved_entries = 0
+        if cache_path:
+            self._load_cache()
+            atexit.register(self.save_cache)
+
+    @staticmethod
+    def _cache_key(message, user_info, route):
+        """提示中會影響回覆的非個人化情境（新用戶歡迎詞、對話狀態、模型路由）都放進鍵中"""
+        audience = 'new' if user_info and not user_info.get('name') else 'known'
+        state = (user_info or {}).get('state') or '-'
+        return f"{audience}|{state}|{route['reason']}|{normalize_message(message)}"
+
+    @staticmethod
+    def _last_booking_parts(user_info):
+        """上次預約的（時間, 服務）；舊資料只有開始時間字串"""
+        last_booking = user_info.get('last_booking')
+        if not last_booking:
+            return []
+        if not isinstance(last_booking, dict):
+            return [str(last_booking)]
+        start_time = last_booking.get('start_time') or ''
+        try:
+            start_time = datetime.fromisoformat(start_time).strftime('%Y-%m-%d %H:%M')
+        except (TypeError, ValueError):
+            start_time = str(start_time)
+        return [part for part in (start_time, last_booking.get('service')) if part]
+
+    @classmethod
+    def _personal_values(cls, user_info):
+        """提示中帶入的個人資料：姓名、電話、常用服務與上次預約"""
+        values = [user_info.get('name'), user_info.get('phone')]
+        values.extend(user_info.get('favorite_services') or [])
+        values.extend(cls._last_booking_parts(user_info))
+        return [value for value in values if value]
+
+    @classmethod
+    def _is_personalized(cls, response, user_info):
+        """回覆中出現提示裡的任何個人資料時不可給其他人共用"""
+        if not user_info:
+            return False
+        return any(value in response for value in cls._personal_values(user_info))
+
+    def _load_cache(self):
+        """從磁碟載入快取，略過已過期的項目"""
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            now = time.time()
+            for key, entry in entries.items():
+                remaining = entry['expires_at'] - now
+                if remaining > 0:
+                    self.response_cache.set(key, (entry['text'], entry['latency']), ttl=remaining)
+            logger.info(f"已載入 {len(self.response_cache)} 筆 ChatGPT 回覆快取")
+            print(f"[LOG] 已載入 {len(self.response_cache)} 筆 ChatGPT 回覆快取")
+        except Exception as e:
+            logger.error(f"載入 ChatGPT 回覆快取失敗: {str(e)}")
+            print(f"[ERROR] 載入 ChatGPT 回覆快取失敗: {str(e)}")
+
+    def save_cache(self):
+        """以暫存檔加 os.replace 原子寫入快取，避免寫到一半的檔案"""
+        if not self.cache_path:
+            return
+        with self._persist_lock:
+            now = time.time()
+            entries = {
+                key: {'text': value[0], 'latency': value[1], 'expires_at': now + remaining}
+                for key, value, remaining in self.response_cache.items()
+            }
+            tmp_path = f"{self.cache_path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+                self._unsaved_entries = 0
+            except Exception as e:
+                logger.error(f"寫入 ChatGPT 回覆快取失敗: {str(e)}")
+                print(f"[ERROR] 寫入 ChatGPT 回覆快取失敗: {str(e)}")
+
+    def _store_response(self, key, response, latency):
+        self.response_cache.set(key, (response, latency))
+        if not self.cache_path:
+            return
+        with self._persist_lock:
+            self._unsaved_entries += 1
+            should_save = self._unsaved_entries >= 20
+        if should_save:
+            self.save_cache()
+
+    def reset_thread_wait(self):
+        """重設目前執行緒累計等待 OpenAI 的時間（每個 webhook 事件開始時呼叫）"""
+        self._thread_local.wait_seconds = 0.0
+
+    def thread_wait_seconds(self):
+        """目前執行緒自上次重設後等待 OpenAI 的秒數"""
+        return getattr(self._thread_local, 'wait_seconds', 0.0)
+
+    def _stream_completion(self, messages, route, result, done, cancel):
+        """在背景執行緒以串流方式取得完整回覆，結果寫入 result 後設定 done"""
+        try:
+            content, usage, first_token = self.client.stream_chat(
+                cancel=cancel,
+                model=route['model'],
+                messages=messages,
+                temperature=0.7,
+                max_tokens=route['max_tokens'],
+                stream_options={'include_usage': True},
+                timeout=self.request_timeout
+            )
+            result['content'] = content
+            result['usage'] = usage
+            if first_token is not None:
+                result['first_token'] = first_token
+        except Exception as e:
+            result['error'] = e
+        finally:
+            done.set()
+
+    def _complete_with_deadline(self, messages, route, deadline, on_deadline):
+        """等待串流完成；超過 deadline 秒時呼叫 on_deadline 送出暫時回覆後繼續等待"""
+        result = {}
+        done = threading.Event()
+        cancel = CancelToken()
+        started = time.monotonic()
+        threading.Thread(target=self._stream_completion, args=(messages, route, result, done, cancel), daemon=True).start()
+        try:
+            if on_deadline and deadline is not None and not done.wait(deadline):
+                logger.info(f"ChatGPT 回覆超過 {deadline} 秒，先送出暫時回覆")
+                print(f"[LOG] ChatGPT 回覆超過 {deadline} 秒，先送出暫時回覆")
+                try:
+                    on_deadline(self.interim_message)
+                except Exception as e:
+                    logger.error(f"送出暫時回覆失敗: {str(e)}")
+                    print(f"[ERROR] 送出暫時回覆失敗: {str(e)}")
+            if not done.wait(max(0.0, self.request_timeout - (time.monotonic() - started))):
+                # 不再等待時關閉串流，背景執行緒不會佔著併發名額直到讀取逾時
+                cancel.cancel()
+                raise TimeoutError(f"OpenAI 回應超過 {self.request_timeout} 秒")
+        finally:
+            waited = time.monotonic() - started
+            self._thread_local.wait_seconds = self.thread_wait_seconds() + waited
+        if 'error' in result:
+            raise result['error']
+        if 'first_token' in result:
+            logger.info(f"ChatGPT 首個 token 耗時 {round((result['first_token'] - started) * 1000)} ms")
+        return result.get('content', ''), waited, result.get('usage')
+
+    def _record_call(self, route, messages, content, latency, usage):
+        """記錄每次呼叫的模型、token 數與延遲，供調整成本與延遲的取捨"""
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) or count_message_tokens(messages)
+        completion_tokens = getattr(usage, 'completion_tokens', None) or count_tokens(content)
+        with self._stats_lock:
+            model_stats = self._model_stats.setdefault(
+                route['model'], {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'latency_total': 0.0}
+            )
+            model_stats['calls'] += 1
+            model_stats['prompt_tokens'] += prompt_tokens
+            model_stats['completion_tokens'] += completion_tokens
+            model_stats['latency_total'] += latency
+        logger.info(
+            f"ChatGPT 呼叫: model={route['model']}, reason={route['reason']}, prompt_tokens={prompt_tokens}, "
+            f"completion_tokens={completion_tokens}, latency_ms={round(latency * 1000)}"
+        )
+        print(f"[LOG] ChatGPT 呼叫: model={route['model']}, prompt_tokens={prompt_tokens}, completion_tokens={completion_tokens}, latency_ms={round(latency * 1000)}")
+
+    def process_message(self, message, user_info=None, use_cache=True, on_deadline=None, deadline=None, history=None):
+        """以 ChatGPT 回覆一般對話；use_cache=False 用於需要個人化的提示。
+        on_deadline 會在超過 deadline 秒（預設 reply_deadline）仍未完成時以暫時回覆文字呼叫一次，
+        history 為先前對話的 chat messages（有對話脈絡時不使用回覆快取）"""
+        route = self.router.route(message, user_info)
+        cache_key = self._cache_key(message, user_info, route) if use_cache and not history else None
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                with self._stats_lock:
+                    self._latency_saved += cached[1]
+                logger.info(f"ChatGPT 回覆快取命中: {cache_key}")
+                return cached[0]
 
-    def process_message(self, message, user_info=None):
         messages = [
             {"role": "system", "content": self.system_prompt}
         ]
+        # 先前對話放在最前面，超出 prompt 預算時會最先被移除
+        messages.extend(history or [])
         # 新用戶歡迎詞（只在沒有暱稱時觸發）
         if user_info and not user_info.get('name'):
             welcome = random.choice(self.welcome_messages)
             messages.append({"role": "assistant", "content": welcome})
         if user_info:
-            user_context = f"""用戶資訊：\n姓名：{user_info.get('name', '')}\n手機：{user_info.get('phone', '')}\n常用服務：{', '.join(user_info.get('favorite_services', []))}\n上次預約：{user_info.get('last_booking', '')}\n"""
+            user_context = f"""用戶資訊：\n姓名：{user_info.get('name', '')}\n手機：{user_info.get('phone', '')}\n常用服務：{', '.join(user_info.get('favorite_services', []))}\n上次預約：{' '.join(self._last_booking_parts(user_info))}\n"""
             messages.append({"role": "system", "content": user_context})
         messages.append({"role": "user", "content": message})
+        messages = fit_messages(messages, self.router.prompt_budget)
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500
+            content, latency, usage = self._complete_with_deadline(
+                messages,
+                route,
+                self.reply_deadline if deadline is None else deadline,
+                on_deadline
             )
-            return response.choices[0].message.content
+            self.llm_latency.record(latency)
+            self._record_call(route, messages, content, latency, usage)
+        except CircuitOpenError:
+            logger.warning("OpenAI 斷路器開啟中，回覆固定訊息")
+            print("[WARNING] OpenAI 斷路器開啟中，回覆固定訊息")
+            return self.fallback_message
         except Exception as e:
-            return f"抱歉，處理您的訊息時發生錯誤：{str(e)}"
+            logger.error(f"ChatGPT 處理訊息失敗: {str(e)}")
+            print(f"[ERROR] ChatGPT 處理訊息失敗: {str(e)}")
+            return self.fallback_message
+
+        if cache_key and content:
+            if self._is_personalized(content, user_info):
+                with self._stats_lock:
+                    self._uncacheable += 1
+            else:
+                self._store_response(cache_key, content, latency)
+        return content
+
+    def stats(self):
+        """回傳回覆快取命中率、省下的等待時間與 OpenAI 呼叫延遲"""
+        with self._stats_lock:
+            latency_saved = self._latency_saved
+            uncacheable = self._uncacheable
+            models = {
+                model: {
+                    'calls': stats['calls'],
+                    'prompt_tokens': stats['prompt_tokens'],
+                    'completion_tokens': stats['completion_tokens'],
+                    'avg_latency_ms': round(stats['latency_total'] * 1000 / stats['calls'], 2)
+                }
+                for model, stats in self._model_stats.items()
+            }
+        return {
+            'response_cache': dict(
+                self.response_cache.stats(),
+                latency_saved_ms=round(latency_saved * 1000, 2),
+                uncacheable=uncacheable,
+                persistent=bool(self.cache_path)
+            ),
+            'llm_latency': self.llm_latency.stats(),
+            'models': models,
+            'client': self.client.stats()
+        }
 
     def format_booking_response(self, response, available_slots):
         if not available_slots:
@@ -54,4 +315,4 @@ class ChatGPTService:
         slots_text = "\n可預約時段：\n"
         for slot in available_slots:
             slots_text += f"- {slot}\n"
-        return response + slots_text 
\ No newline at end of file
+        return response + slots_text
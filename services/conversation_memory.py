@@ -0,0 +1,58 @@
+from services.llm_routing import count_tokens
+
+# 摘要中每則訊息保留的字數
+_SUMMARY_SNIPPET_CHARS = 40
+_ROLE_LABELS = {'user': '客人', 'assistant': '小幫手'}
+
+class ConversationMemory:
+    def __init__(self, max_tokens=600, summary_max_chars=200, field='conversation'):
+        self.max_tokens = max_tokens
+        self.summary_max_chars = summary_max_chars
+        self.field = field
+
+    def load(self, session):
+        """從 session 取得對話記憶 {'turns': [...], 'summary': str}"""
+        state = session.get(self.field) or {}
+        return {'turns': list(state.get('turns', [])), 'summary': state.get('summary', '')}
+
+    def _summarize(self, summary, turn):
+        """以每則訊息的開頭片段累積摘要，只保留最近的部分，不呼叫 LLM"""
+        content = turn['content'].replace('\n', ' ').replace('；', '，')
+        if len(content) > _SUMMARY_SNIPPET_CHARS:
+            content = content[:_SUMMARY_SNIPPET_CHARS] + '…'
+        snippet = f"{_ROLE_LABELS.get(turn['role'], turn['role'])}：{content}"
+        snippets = (summary.split('；') if summary else []) + [snippet]
+        # 超過長度時從最舊的片段開始捨棄
+        while len(snippets) > 1 and len('；'.join(snippets)) > self.summary_max_chars:
+            snippets.pop(0)
+        return '；'.join(snippets)[-self.summary_max_chars:]
+
+    def record(self, session, user_message, reply):
+        """加入一來一往的對話，超過 token 上限時把最舊的訊息併入摘要"""
+        state = self.load(session)
+        turns = state['turns']
+        turns.append({'role': 'user', 'content': user_message})
+        if reply:
+            turns.append({'role': 'assistant', 'content': reply})
+
+        total = sum(count_tokens(turn['content']) for turn in turns)
+        summary = state['summary']
+        while turns and total > self.max_tokens:
+            oldest = turns.pop(0)
+            total -= count_tokens(oldest['content'])
+            summary = self._summarize(summary, oldest)
+
+        session.update({self.field: {'turns': turns, 'summary': summary}})
+
+    def reset(self, session):
+        """清除對話記憶（新的對話階段開始時使用）"""
+        session.update({self.field: {'turns': [], 'summary': ''}})
+
+    def to_messages(self, session):
+        """轉為 chat messages：先放摘要，再放保留的對話"""
+        state = self.load(session)
+        messages = []
+        if state['summary']:
+            messages.append({'role': 'system', 'content': f"先前對話摘要：{state['summary']}"})
+        messages.extend({'role': turn['role'], 'content': turn['content']} for turn in state['turns'])
+        return messages
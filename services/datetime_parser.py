@@ -0,0 +1,151 @@
+import re
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from services.slot_grid import TAIPEI_TZ, BUSINESS_OPEN_HOUR
+
+# 中文數字（小時用，最多到十二）
+_CN_DIGITS = {'零': 0, '一': 1, '二': 2, '兩': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_CN_NUMBER = '[零一二兩两三四五六七八九十]{1,3}'
+_WEEKDAYS = {'一': 0, '二': 1, '三': 2, '四': 3, '五': 4, '六': 5, '日': 6, '天': 6}
+_RELATIVE_DAYS = {'今天': 0, '今日': 0, '明天': 1, '明日': 1, '後天': 2, '大後天': 3}
+
+# 日期：含年份、月/日、相對日期、星期、幾號
+_FULL_DATE = re.compile(r"(20\d{2})[-/.年 ]?(\d{1,2})[-/.月 ]?(\d{1,2})[日號号]?")
+_MONTH_DAY = re.compile(r"(?<!\d)(\d{1,2})(?:[/\-.]|月)(\d{1,2})(?!\d)[日號号]?")
+_RELATIVE_DAY = re.compile(r"大後天|後天|明天|明日|今天|今日")
+_WEEKDAY = re.compile(r"(下下|下|這|本)?\s*(?:週|周|星期|禮拜)([一二三四五六日天])")
+_DAY_OF_MONTH = re.compile(r"(?<![\d/\-.])(\d{1,2})[號号日]")
+
+# 時間：X點半、HH:MM、X點Y分、單獨數字
+_HALF = re.compile(rf"(\d{{1,2}}|{_CN_NUMBER})\s*[點点時:：.]\s*半")
+_CLOCK = re.compile(r"(?<!\d)(\d{1,2})[:：.](\d{1,2})(?!\d)")
+_HOUR = re.compile(rf"(\d{{1,2}}|{_CN_NUMBER})\s*[點点時](?:\s*(\d{{1,2}})\s*分?)?")
+_BARE_HOUR = re.compile(r"^\s*(\d{1,2})\s*$")
+
+_AM_WORDS = ('上午', '早上')
+_PM_WORDS = ('下午', '晚上', '傍晚', '中午')
+
+def _cn_to_int(text):
+    """將數字或中文數字（如 兩、十一）轉為整數"""
+    if text.isdigit():
+        return int(text)
+    if '十' in text:
+        tens, _, ones = text.partition('十')
+        return (_CN_DIGITS.get(tens, 1) if tens else 1) * 10 + (_CN_DIGITS.get(ones, 0) if ones else 0)
+    return _CN_DIGITS.get(text)
+
+def _valid_date(year, month, day):
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+def _upcoming(today, month, day):
+    """未指定年份的月/日：今年已過的日期視為明年"""
+    candidate = _valid_date(today.year, month, day)
+    if candidate is None:
+        return None
+    if candidate < today:
+        candidate = _valid_date(today.year + 1, month, day)
+    return candidate
+
+def _parse_date(text, today):
+    """回傳 (日期, 比對到的區間)，找不到時回傳 (None, None)"""
+    match = _FULL_DATE.search(text)
+    if match:
+        parsed = _valid_date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if parsed:
+            return parsed, match.span()
+
+    for match in _MONTH_DAY.finditer(text):
+        parsed = _upcoming(today, int(match.group(1)), int(match.group(2)))
+        if parsed:
+            return parsed, match.span()
+
+    match = _RELATIVE_DAY.search(text)
+    if match:
+        return today + timedelta(days=_RELATIVE_DAYS[match.group(0)]), match.span()
+
+    match = _WEEKDAY.search(text)
+    if match:
+        prefix, weekday = match.group(1), _WEEKDAYS[match.group(2)]
+        if prefix in ('下', '下下'):
+            # 下週X：下週一起算的那一週
+            next_monday = today + timedelta(days=7 - today.weekday())
+            parsed = next_monday + timedelta(days=weekday + (7 if prefix == '下下' else 0))
+        else:
+            # 週X / 這週X：今天或之後最近的那一天
+            parsed = today + timedelta(days=(weekday - today.weekday()) % 7)
+        return parsed, match.span()
+
+    match = _DAY_OF_MONTH.search(text)
+    if match:
+        day = int(match.group(1))
+        parsed = _valid_date(today.year, today.month, day)
+        if parsed is None or parsed < today:
+            # 本月已過，改為下個月的同一天
+            next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+            parsed = _valid_date(next_month.year, next_month.month, day)
+        if parsed:
+            return parsed, match.span()
+
+    return None, None
+
+def _resolve_hour(hour, text, literal):
+    """依上午/下午等字詞換算 24 小時制。
+    未指明時：HH:MM 視為 24 小時制；X點、X點半與單獨數字在 12 點前預設為下午，
+    但營業時間內的上午時段（例如 10、11 點）維持上午"""
+    if any(word in text for word in _AM_WORDS):
+        return hour
+    if any(word in text for word in _PM_WORDS):
+        return hour + 12 if hour < 12 else hour
+    if literal or hour >= 12:
+        return hour
+    return hour if hour >= BUSINESS_OPEN_HOUR else hour + 12
+
+def _parse_time(text):
+    """回傳 'HH:MM'，找不到或不合理時回傳 None"""
+    match = _HALF.search(text)
+    if match:
+        hour, minute, literal = _cn_to_int(match.group(1)), 30, False
+    else:
+        match = _CLOCK.search(text)
+        if match:
+            hour, minute, literal = int(match.group(1)), int(match.group(2)), True
+        else:
+            match = _HOUR.search(text) or _BARE_HOUR.search(text)
+            if not match:
+                return None
+            hour = _cn_to_int(match.group(1))
+            minute = int(match.group(2)) if match.lastindex and match.lastindex > 1 and match.group(2) else 0
+            literal = False
+
+    if hour is None:
+        return None
+    hour = _resolve_hour(hour, text, literal)
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+@lru_cache(maxsize=2048)
+def _parse_cached(text, today_ordinal):
+    today = date.fromordinal(today_ordinal)
+    parsed_date, span = _parse_date(text, today)
+    if span:
+        # 時間只在日期以外的部分尋找，避免把日期數字當成小時
+        text = f"{text[:span[0]]} {text[span[1]:]}"
+    return (parsed_date.strftime("%Y-%m-%d") if parsed_date else None, _parse_time(text))
+
+def parse_datetime(text, today=None):
+    """解析訊息中的日期與時間，回傳 {'date': 'YYYY-MM-DD' 或 None, 'time': 'HH:MM' 或 None}"""
+    if today is None:
+        today = datetime.now(TAIPEI_TZ).date()
+    parsed_date, parsed_time = _parse_cached((text or '').strip(), today.toordinal())
+    return {'date': parsed_date, 'time': parsed_time}
+
+def cache_info():
+    """解析結果快取的命中統計"""
+    return _parse_cached.cache_info()._asdict()
+
+def clear_cache():
+    _parse_cached.cache_clear()
@@ -0,0 +1,104 @@
+import threading
+import logging
+from datetime import datetime, timedelta, timezone
+from services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class InMemoryDedupeStore:
+    def __init__(self, max_size=10000, ttl=3600):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def mark_if_new(self, event_id):
+        """記錄事件 ID，若已處理過則回傳 False"""
+        return self._cache.add(event_id, True)
+
+    def forget(self, event_id):
+        """處理失敗時移除紀錄，讓 LINE 重送的事件能再次處理"""
+        self._cache.pop(event_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+class FirestoreDedupeStore:
+    def __init__(self, db, collection='webhook_events', ttl=3600):
+        self.db = db
+        self.collection = collection
+        self.ttl = ttl
+
+    def mark_if_new(self, event_id):
+        """以 Firestore create 的原子性記錄事件 ID，可跨多個行程共用"""
+        from google.api_core.exceptions import AlreadyExists, Conflict
+        doc_ref = self.db.collection(self.collection).document(event_id)
+        now = datetime.now(timezone.utc)
+        data = {'created_at': now, 'expires_at': now + timedelta(seconds=self.ttl)}
+        try:
+            doc_ref.create(data)
+            return True
+        except (AlreadyExists, Conflict):
+            doc = doc_ref.get()
+            expires_at = doc.to_dict().get('expires_at') if doc.exists else None
+            if expires_at and expires_at <= now:
+                # 過期紀錄視為新事件（Firestore TTL 策略可能尚未清除）
+                doc_ref.set(data)
+                return True
+            return False
+
+    def forget(self, event_id):
+        """處理失敗時移除紀錄，讓 LINE 重送的事件能再次處理"""
+        self.db.collection(self.collection).document(event_id).delete()
+
+    def stats(self):
+        return {'backend': 'firestore', 'collection': self.collection}
+
+class WebhookEventDeduplicator:
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._forgotten = 0
+
+    def is_duplicate(self, event):
+        """檢查 webhookEventId 是否已處理過（LINE 重送的事件）"""
+        event_id = getattr(event, 'webhook_event_id', None)
+        if not event_id:
+            return False
+        try:
+            is_new = self.store.mark_if_new(event_id)
+        except Exception as e:
+            # 去重儲存失敗時寧可重複處理，也不要遺失事件
+            logger.error(f"檢查重複事件失敗: {str(e)}")
+            print(f"[ERROR] 檢查重複事件失敗: {str(e)}")
+            return False
+        with self._lock:
+            if is_new:
+                self._misses += 1
+            else:
+                self._hits += 1
+        if not is_new:
+            logger.info(f"略過重複的 webhook 事件: {event_id}")
+            print(f"[LOG] 略過重複的 webhook 事件: {event_id}")
+        return not is_new
+
+    def forget(self, event):
+        """事件未能處理時撤銷已處理的標記"""
+        event_id = getattr(event, 'webhook_event_id', None)
+        if not event_id:
+            return
+        try:
+            self.store.forget(event_id)
+            with self._lock:
+                self._forgotten += 1
+        except Exception as e:
+            logger.error(f"移除事件 {event_id} 的去重紀錄失敗: {str(e)}")
+            print(f"[ERROR] 移除事件 {event_id} 的去重紀錄失敗: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'forgotten': self._forgotten,
+                'misses': self._misses,
+                'store': self.store.stats()
+            }
@@ -0,0 +1,91 @@
+import queue
+import threading
+import time
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class EventWorkerPool:
+    def __init__(self, num_workers=4, max_queue_size=100, name='webhook-worker'):
+        self.num_workers = max(1, num_workers)
+        self.name = name
+        self._queue = queue.Queue(maxsize=max(1, max_queue_size))
+        self._lock = threading.Lock()
+        self._threads = []
+        self._started_at = None
+        self._busy_workers = 0
+        self._busy_seconds = 0.0
+        self._queue_wait_seconds = 0.0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self):
+        """啟動背景工作執行緒（重複呼叫不會重複啟動）"""
+        with self._lock:
+            if self._threads:
+                return
+            self._started_at = time.monotonic()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"背景工作池已啟動，工作執行緒數量: {self.num_workers}，佇列上限: {self._queue.maxsize}")
+        print(f"[LOG] 背景工作池已啟動，工作執行緒數量: {self.num_workers}，佇列上限: {self._queue.maxsize}")
+
+    def submit(self, func, *args):
+        """將工作放入佇列，佇列已滿時回傳 False 由呼叫端自行處理"""
+        if not self._threads:
+            # 延遲到第一次使用才啟動，避免 gunicorn 預載入後 fork 掉執行緒
+            self.start()
+        try:
+            self._queue.put_nowait((func, args, time.monotonic()))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            logger.warning(f"背景工作佇列已滿 ({self._queue.maxsize})，無法加入新工作")
+            print(f"[WARNING] 背景工作佇列已滿 ({self._queue.maxsize})，無法加入新工作")
+            return False
+
+    def _worker_loop(self):
+        while True:
+            func, args, enqueued_at = self._queue.get()
+            started = time.monotonic()
+            with self._lock:
+                self._busy_workers += 1
+                self._queue_wait_seconds += started - enqueued_at
+            failed = False
+            try:
+                func(*args)
+            except Exception as e:
+                failed = True
+                logger.error(f"背景工作執行失敗: {str(e)}\n{traceback.format_exc()}")
+                print(f"[ERROR] 背景工作執行失敗: {str(e)}")
+            finally:
+                with self._lock:
+                    self._busy_workers -= 1
+                    self._busy_seconds += time.monotonic() - started
+                    self._processed += 1
+                    if failed:
+                        self._failed += 1
+                self._queue.task_done()
+
+    def stats(self):
+        """回傳佇列深度與工作執行緒使用率"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at if self._started_at else 0
+            capacity_seconds = elapsed * self.num_workers
+            processed = self._processed
+            return {
+                'workers': self.num_workers,
+                'busy_workers': self._busy_workers,
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self._queue.maxsize,
+                'processed': processed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'utilization': round(self._busy_seconds / capacity_seconds, 4) if capacity_seconds else 0.0,
+                'avg_queue_wait_ms': round(self._queue_wait_seconds * 1000 / processed, 2) if processed else 0.0
+            }
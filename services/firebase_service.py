@@ -64,17 +64,24 @@ class FirebaseService:
         doc = doc_ref.get()
         return doc.to_dict() if doc.exists else None
 
+    def get_user_fields(self, user_id, field_paths):
+        """只讀取用戶文件中的指定欄位，文件不存在時回傳 None"""
+        doc = self.db.collection('users').document(user_id).get(field_paths=list(field_paths))
+        return (doc.to_dict() or {}) if doc.exists else None
+
     def create_user(self, user_id, user_data):
-        """創建新用戶"""
+        """創建新用戶，回傳寫入的資料"""
         doc_ref = self.db.collection('users').document(user_id)
-        doc_ref.set({
+        new_user = {
             'name': user_data.get('name', ''),
             'phone': user_data.get('phone', ''),
             'favorite_services': user_data.get('favorite_services', []),
             'last_booking': None,
             'created_at': datetime.now(),
             'updated_at': datetime.now()
-        })
+        }
+        doc_ref.set(new_user)
+        return dict(new_user)
 
     def update_user(self, user_id, user_data):
         """更新用戶資訊"""
@@ -95,10 +102,51 @@ class FirebaseService:
             'last_booking': booking_data['start_time']
         })
 
-    def get_booking_history(self, user_id):
-        """獲取用戶預約歷史"""
-        bookings_ref = self.db.collection('users').document(user_id)\
-            .collection('bookings')
-        docs = bookings_ref.order_by('start_time', direction=firestore.Query.DESCENDING).stream()
+    def commit_booking(self, user_id, booking_data, user_data):
+        """以單一 WriteBatch 寫入預約記錄與用戶欄位，兩者同時成功或同時失敗"""
+        user_ref = self.db.collection('users').document(user_id)
+        # 有日曆事件 ID 時作為文件 ID，重送同一筆預約只會覆寫同一份記錄
+        booking_ref = user_ref.collection('bookings').document(booking_data.get('calendar_event_id') or None)
+        
+        batch = self.db.batch()
+        batch.set(booking_ref, dict(booking_data, created_at=datetime.now()))
+        batch.update(user_ref, dict(user_data, updated_at=datetime.now()))
+        batch.commit()
+
+    def _bookings_query(self, user_id):
+        """依開始時間由新到舊排序，同一時間再以文件 ID 排序，確保分頁游標唯一"""
+        return self.db.collection('users').document(user_id).collection('bookings')\
+            .order_by('start_time', direction=firestore.Query.DESCENDING)\
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+
+    def get_booking_history(self, user_id, limit=20, cursor=None):
+        """分頁獲取用戶預約歷史，回傳 (預約列表, 下一頁游標)；沒有下一頁時游標為 None"""
+        query = self._bookings_query(user_id)
+        if cursor:
+            # 游標格式為「start_time|文件 ID」
+            start_time, doc_id = cursor.split('|', 1)
+            query = query.start_after({'start_time': start_time, '__name__': doc_id})
+        
+        bookings = []
+        next_cursor = None
+        for doc in query.limit(limit).stream():
+            booking = doc.to_dict()
+            booking['id'] = doc.id
+            bookings.append(booking)
+            next_cursor = f"{booking.get('start_time', '')}|{doc.id}"
         
-        return [doc.to_dict() for doc in docs] 
\ No newline at end of file
+        return bookings, (next_cursor if len(bookings) == limit else None)
+
+    def iter_booking_history(self, user_id, page_size=100):
+        """逐頁讀取全部預約歷史的產生器，供匯出使用，記憶體只保留一頁"""
+        cursor = None
+        while True:
+            bookings, cursor = self.get_booking_history(user_id, limit=page_size, cursor=cursor)
+            yield from bookings
+            if not cursor:
+                return
+
+    def get_latest_bookings(self, user_id, n=1):
+        """只讀取最新的 n 筆預約"""
+        bookings, _ = self.get_booking_history(user_id, limit=n)
+        return bookings
@@ -0,0 +1,112 @@
+from collections import deque
+
+class KeywordAutomaton:
+    """Aho-Corasick 多關鍵字比對：建好後掃描一次文字即可找出所有出現的關鍵字"""
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._built = False
+
+    def add(self, keyword, payload):
+        """加入關鍵字與對應的 payload（同一關鍵字可對應多個 payload）"""
+        if not keyword:
+            return
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((len(keyword), payload))
+        self._built = False
+
+    def build(self):
+        """以 BFS 建立失敗連結，並把失敗狀態的輸出併入，掃描時不必再沿連結回溯"""
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        self._built = True
+        return self
+
+    def find_all(self, text):
+        """回傳所有出現的 (開始位置, 結束位置, payload)，依結束位置排序"""
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, payload in output[state]:
+                matches.append((index + 1 - length, index + 1, payload))
+        return matches
+
+    def __len__(self):
+        return len(self._goto)
+
+class IntentMatch:
+    """單則訊息的比對結果：各分類命中的標籤，依關鍵字表的順序排列"""
+    def __init__(self, text, hits, full_span):
+        # hits 為 {分類: {標籤: 建表順序}}
+        self.text = text
+        self._hits = hits
+        self._full_span = full_span
+
+    def has(self, category, label=None):
+        labels = self._hits.get(category)
+        if not labels:
+            return False
+        return label is None or label in labels
+
+    def labels(self, category):
+        """命中的標籤，依建表時的順序"""
+        return [label for label, _ in sorted(self._hits.get(category, {}).items(), key=lambda item: item[1])]
+
+    def first(self, category):
+        """建表順序最前面的命中標籤，沒有命中時回傳 None"""
+        labels = self.labels(category)
+        return labels[0] if labels else None
+
+    def is_exact(self, category):
+        """整則訊息是否恰好等於該分類的某個關鍵字"""
+        return category in self._full_span
+
+class IntentMatcher:
+    def __init__(self, tables):
+        """tables 為 {分類: {標籤: [關鍵字, ...]}}，關鍵字以小寫比對"""
+        self.automaton = KeywordAutomaton()
+        self.keyword_count = 0
+        for category, labels in tables.items():
+            for order, (label, keywords) in enumerate(labels.items()):
+                for keyword in keywords:
+                    self.automaton.add(keyword.lower(), (category, label, order))
+                    self.keyword_count += 1
+        self.automaton.build()
+
+    def match(self, text):
+        """掃描一次訊息，回傳所有命中的意圖、服務與主題"""
+        lowered = (text or '').lower()
+        hits = {}
+        full_span = set()
+        for start, end, (category, label, order) in self.automaton.find_all(lowered):
+            hits.setdefault(category, {})[label] = order
+            if start == 0 and end == len(lowered):
+                full_span.add(category)
+        return IntentMatch(text, hits, full_span)
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from services.intent_matcher import KeywordAutomaton
+
+logger = logging.getLogger(__name__)
+
+class KnowledgeIndex:
+    """由知識庫檔案編譯出的唯讀索引：關鍵字 → 主題的自動機，以及預先組好的回覆片段"""
+    def __init__(self, data):
+        self.automaton = KeywordAutomaton()
+        self.faq_answers = []
+        self.topics = []
+        self.keyword_count = 0
+
+        tips_by_topic = {}
+        for order, topic in enumerate(data.get('topics', [])):
+            tips = list(topic.get('tips', []))
+            tips_by_topic[topic['name']] = tips
+            # 每條建議先組成「✨ 建議\n」，回覆時只需挑選與串接
+            self.topics.append((f"關於「{topic['name']}」的專業建議：\n\n", [f"✨ {tip}\n" for tip in tips]))
+            self._add_keywords(topic.get('keywords', []), ('topic', order))
+
+        # 常見問題的回覆是固定內容，載入時就套好模板
+        for order, faq in enumerate(data.get('faq', [])):
+            self.faq_answers.append(faq['template'].format(*tips_by_topic.get(faq.get('topic'), [])))
+            self._add_keywords(faq.get('keywords', []), ('faq', order))
+
+        self.automaton.build()
+
+    def _add_keywords(self, keywords, payload):
+        for keyword in keywords:
+            self.automaton.add(keyword.lower(), payload)
+            self.keyword_count += 1
+
+    def lookup(self, text, sample_size=3):
+        """掃描一次訊息：常見問題優先，其次為檔案中順序最前的主題；沒有命中時回傳 None"""
+        best = None
+        for _, _, payload in self.automaton.find_all((text or '').lower()):
+            if best is None or payload < best:
+                best = payload
+        if best is None:
+            return None
+        kind, order = best
+        if kind == 'faq':
+            return self.faq_answers[order]
+        header, fragments = self.topics[order]
+        return header + ''.join(random.sample(fragments, min(sample_size, len(fragments))))
+
+class KnowledgeBase:
+    def __init__(self, path, check_interval=5):
+        """path 為知識庫 JSON 檔；每隔 check_interval 秒檢查一次修改時間，變更時重新載入"""
+        self.path = path
+        self.check_interval = check_interval
+        self._index = None
+        self._mtime = None
+        self._checked_at = 0
+        self._reload_lock = threading.Lock()
+        self._counters = {'lookups': 0, 'hits': 0, 'reloads': 0, 'reload_errors': 0}
+        self.reload()
+
+    def reload(self):
+        """重新編譯索引後才一次替換，查詢中的請求不會看到一半的內容；失敗時保留舊索引"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf-8') as f:
+                index = KnowledgeIndex(json.load(f))
+        except Exception as e:
+            self._counters['reload_errors'] += 1
+            logger.error(f"載入美容知識庫失敗: {str(e)}")
+            print(f"[ERROR] 載入美容知識庫失敗: {str(e)}")
+            return False
+
+        self._index = index
+        self._mtime = mtime
+        self._counters['reloads'] += 1
+        logger.info(f"已載入美容知識庫：{len(index.topics)} 個主題、{index.keyword_count} 個關鍵字")
+        print(f"[LOG] 已載入美容知識庫：{len(index.topics)} 個主題、{index.keyword_count} 個關鍵字")
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        # 同一時間只由一個執行緒檢查，其他請求直接使用現有索引
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if mtime != self._mtime:
+                # 先記下修改時間，檔案內容有誤時不會每次檢查都重試
+                self._mtime = mtime
+                self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def lookup(self, text):
+        """根據用戶問題提供美容相關知識，找不到時回傳 None"""
+        self._maybe_reload()
+        index = self._index
+        self._counters['lookups'] += 1
+        if index is None:
+            return None
+        response = index.lookup(text)
+        if response:
+            self._counters['hits'] += 1
+        return response
+
+    def stats(self):
+        index = self._index
+        stats = dict(self._counters)
+        stats['topics'] = len(index.topics) if index else 0
+        stats['keywords'] = index.keyword_count if index else 0
+        return stats
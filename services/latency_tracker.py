@@ -0,0 +1,71 @@
+import threading
+from collections import deque
+
+class LatencyTracker:
+    def __init__(self, window_size=1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window_size)
+        self._count = 0
+        self._total = 0.0
+
+    def record(self, seconds):
+        """記錄一次耗時（秒）"""
+        with self._lock:
+            self._samples.append(seconds)
+            self._count += 1
+            self._total += seconds
+
+    def stats(self):
+        """回傳累計次數、平均值與最近樣本的百分位數（毫秒）"""
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self._count
+            total = self._total
+        if not samples:
+            return {'count': count, 'avg_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+
+        def percentile(p):
+            index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+            return round(samples[index] * 1000, 2)
+
+        return {
+            'count': count,
+            'avg_ms': round(total * 1000 / count, 2),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': round(samples[-1] * 1000, 2)
+        }
+
+class StateLatencyTracker:
+    """依對話狀態分別統計處理耗時，以及 Google Calendar 調用次數與等待 OpenAI 的時間"""
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._external = {}
+
+    def record(self, state, seconds, calendar_calls=0, llm_wait=0.0):
+        """記錄某個狀態的一次處理耗時（秒）與期間的外部呼叫"""
+        with self._lock:
+            tracker = self._latency.get(state)
+            if tracker is None:
+                tracker = self._latency[state] = LatencyTracker(self.window_size)
+                self._external[state] = {'calendar_api_calls': 0, 'llm_wait_seconds': 0.0}
+            self._external[state]['calendar_api_calls'] += calendar_calls
+            self._external[state]['llm_wait_seconds'] += llm_wait
+            tracker.record(seconds)
+
+    def stats(self):
+        """每個狀態的延遲百分位數（毫秒）、Google Calendar 調用總次數與平均等待 OpenAI 的時間"""
+        with self._lock:
+            states = [(state, tracker, dict(self._external[state])) for state, tracker in self._latency.items()]
+        result = {}
+        for state, tracker, external in states:
+            stats = tracker.stats()
+            count = max(stats['count'], 1)
+            stats['calendar_api_calls'] = external['calendar_api_calls']
+            stats['avg_calendar_api_calls'] = round(external['calendar_api_calls'] / count, 2)
+            stats['avg_llm_wait_ms'] = round(external['llm_wait_seconds'] * 1000 / count, 2)
+            result[state] = stats
+        return result
@@ -0,0 +1,134 @@
+import time
+import uuid
+import threading
+import logging
+from linebot.v3.messaging import (
+    MessagingApi, ApiClient, ReplyMessageRequest, PushMessageRequest, TextMessage
+)
+from linebot.v3.messaging.exceptions import ApiException
+from urllib3.exceptions import HTTPError
+from services.latency_tracker import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# LINE 每次 reply / push 最多可帶 5 則訊息
+MAX_MESSAGES_PER_REQUEST = 5
+
+class LineMessageDispatcher:
+    def __init__(self, configuration, max_retries=3, backoff_base=0.5):
+        # 共用同一個 ApiClient，底層 urllib3 連線池會保持 keep-alive 連線
+        self.api_client = ApiClient(configuration)
+        self.messaging_api = MessagingApi(self.api_client)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.send_latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self._counters = {
+            'replies': 0,
+            'pushes': 0,
+            'retries': 0,
+            'push_fallbacks': 0,
+            'failures': 0
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @staticmethod
+    def _build_messages(texts):
+        messages = [TextMessage(text=text) for text in texts if text]
+        return [messages[i:i + MAX_MESSAGES_PER_REQUEST] for i in range(0, len(messages), MAX_MESSAGES_PER_REQUEST)]
+
+    @staticmethod
+    def _is_invalid_reply_token(error):
+        if not isinstance(error, ApiException) or error.status != 400:
+            return False
+        body = error.body.decode('utf-8', 'ignore') if isinstance(error.body, bytes) else str(error.body or '')
+        return 'reply token' in body.lower()
+
+    @staticmethod
+    def _is_transient(error):
+        if isinstance(error, ApiException):
+            return error.status == 429 or (error.status or 0) >= 500
+        return isinstance(error, HTTPError)
+
+    def _call_with_retry(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_transient(e):
+                    raise
+                delay = self.backoff_base * (2 ** attempt)
+                attempt += 1
+                self._count('retries')
+                logger.warning(f"LINE API 暫時性錯誤，{delay} 秒後重試（第 {attempt} 次）: {str(e)}")
+                print(f"[WARNING] LINE API 暫時性錯誤，{delay} 秒後重試（第 {attempt} 次）")
+                time.sleep(delay)
+
+    def _push_batch(self, user_id, messages):
+        # 同一批訊息重試時使用相同的 retry key，避免重複推播
+        retry_key = str(uuid.uuid4())
+        self._call_with_retry(
+            self.messaging_api.push_message,
+            PushMessageRequest(to=user_id, messages=messages),
+            x_line_retry_key=retry_key
+        )
+        self._count('pushes')
+
+    def reply(self, reply_token, texts, user_id=None):
+        """以 reply token 回覆訊息，超過單次上限的訊息或 token 失效時改用 push"""
+        batches = self._build_messages(texts)
+        if not batches:
+            return
+        started = time.monotonic()
+        try:
+            try:
+                self._call_with_retry(
+                    self.messaging_api.reply_message,
+                    ReplyMessageRequest(reply_token=reply_token, messages=batches[0])
+                )
+                self._count('replies')
+            except Exception as e:
+                if not (user_id and self._is_invalid_reply_token(e)):
+                    raise
+                logger.warning(f"reply token 已失效，改用 push 傳送給用戶 {user_id}")
+                print(f"[WARNING] reply token 已失效，改用 push 傳送給用戶 {user_id}")
+                self._count('push_fallbacks')
+                self._push_batch(user_id, batches[0])
+
+            # reply token 只能使用一次，其餘訊息以 push 傳送
+            for batch in batches[1:]:
+                if not user_id:
+                    logger.warning(f"缺少用戶 ID，捨棄 {len(batch)} 則超出上限的訊息")
+                    break
+                self._push_batch(user_id, batch)
+        except Exception as e:
+            self._count('failures')
+            logger.error(f"傳送 LINE 訊息失敗: {str(e)}")
+            print(f"[ERROR] 傳送 LINE 訊息失敗: {str(e)}")
+            raise
+        finally:
+            self.send_latency.record(time.monotonic() - started)
+
+    def push(self, user_id, texts):
+        """主動推播訊息給用戶"""
+        started = time.monotonic()
+        try:
+            for batch in self._build_messages(texts):
+                self._push_batch(user_id, batch)
+        except Exception as e:
+            self._count('failures')
+            logger.error(f"推播 LINE 訊息失敗: {str(e)}")
+            print(f"[ERROR] 推播 LINE 訊息失敗: {str(e)}")
+            raise
+        finally:
+            self.send_latency.record(time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters['send_latency'] = self.send_latency.stats()
+        return counters
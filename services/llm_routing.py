@@ -0,0 +1,87 @@
+import math
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    # 未安裝 tiktoken 時改用本地估算
+    _ENCODING = None
+
+# 中日韓文字大約一個字一個 token，其他字元約四個字元一個 token
+_CJK = re.compile('[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+# 每則訊息額外的格式開銷（role 與分隔符號）
+_MESSAGE_OVERHEAD = 4
+_REPLY_PRIMING = 2
+
+# 需要較深入建議的諮詢類問題交給大模型
+CONSULTATION_KEYWORDS = [
+    '推薦', '建議', '適合', '比較', '差別', '差異', '為什麼', '怎麼選',
+    '過敏', '敏感', '痘', '斑', '保養', '療程', '副作用', '術後'
+]
+
+def count_tokens(text):
+    """計算文字的 token 數，沒有 tiktoken 時以中日韓字數與其他字元長度估算"""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def count_message_tokens(messages):
+    """計算 chat messages 的 prompt token 數"""
+    return sum(count_tokens(message['content']) + _MESSAGE_OVERHEAD for message in messages) + _REPLY_PRIMING
+
+def _truncate_to_tokens(text, budget):
+    if _ENCODING is not None:
+        return _ENCODING.decode(_ENCODING.encode(text)[:budget])
+    # 估算模式下從尾端逐步截短直到符合預算
+    while text and count_tokens(text) > budget:
+        text = text[:max(0, len(text) - max(1, (count_tokens(text) - budget)))]
+    return text
+
+def fit_messages(messages, budget):
+    """將 messages 控制在 prompt 預算內：保留第一則 system prompt 與最後一則用戶訊息，
+    先由舊到新移除中間的情境訊息，仍超出時截短用戶訊息"""
+    messages = list(messages)
+    while len(messages) > 2 and count_message_tokens(messages) > budget:
+        del messages[1]
+    over = count_message_tokens(messages) - budget
+    if over > 0:
+        last = dict(messages[-1])
+        last['content'] = _truncate_to_tokens(last['content'], max(0, count_tokens(last['content']) - over))
+        messages[-1] = last
+    return messages
+
+class ModelRouter:
+    def __init__(self, fast_model='gpt-4o-mini', large_model='gpt-4', fast_max_tokens=300,
+                 large_max_tokens=500, prompt_budget=1500, long_message_chars=80):
+        self.fast_model = fast_model
+        self.large_model = large_model
+        self.fast_max_tokens = fast_max_tokens
+        self.large_max_tokens = large_max_tokens
+        self.prompt_budget = prompt_budget
+        self.long_message_chars = long_message_chars
+
+    def route(self, message, user_info=None):
+        """依訊息意圖、長度與用戶狀態選擇模型，回傳 {'model', 'max_tokens', 'reason'}"""
+        state = (user_info or {}).get('state') or ''
+        if state.startswith('booking_') or state.startswith('ask_'):
+            # 預約或建檔流程中的閒聊只需簡短引導回流程，優先回應速度
+            reason = 'in_flow'
+        elif user_info is not None and not user_info.get('name'):
+            reason = 'new_user'
+        elif any(keyword in message for keyword in CONSULTATION_KEYWORDS):
+            reason = 'consultation'
+        elif len(message) > self.long_message_chars:
+            reason = 'long_message'
+        else:
+            reason = 'chit_chat'
+
+        if reason in ('consultation', 'long_message'):
+            return {'model': self.large_model, 'max_tokens': self.large_max_tokens, 'reason': reason}
+        return {'model': self.fast_model, 'max_tokens': self.fast_max_tokens, 'reason': reason}
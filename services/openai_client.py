@@ -0,0 +1,225 @@
+import time
+import threading
+import logging
+import openai
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    pass
+
+class ConcurrencyLimitError(Exception):
+    pass
+
+class StreamCancelledError(Exception):
+    pass
+
+class CancelToken:
+    """呼叫端放棄等待時取消串流：設定旗標並關閉已開啟的連線，讓背景執行緒盡快釋放併發名額"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._close = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            close, self._close = self._close, None
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"關閉 OpenAI 串流失敗: {str(e)}")
+
+    def attach(self, close):
+        """登記關閉目前串流的函式，已取消時回傳 False"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._close = close
+            return True
+
+    def detach(self):
+        with self._lock:
+            self._close = None
+
+    def wait(self, seconds):
+        """等待 seconds 秒，期間被取消時提早返回"""
+        return self._event.wait(seconds)
+
+class OpenAIClient:
+    def __init__(self, api_key=None, timeout=30, max_concurrency=8, max_retries=3, backoff_base=0.5,
+                 max_backoff=10, failure_threshold=5, recovery_time=30):
+        self.api_key = api_key
+        self._client = None
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._counters = {
+            'calls': 0,
+            'retries': 0,
+            'failures': 0,
+            'rejected': 0,
+            'short_circuited': 0,
+            'circuit_opened': 0,
+            'cancelled': 0
+        }
+
+    @property
+    def client(self):
+        # 第一次使用時才建立並長期共用同一個 client，底層 HTTP 連線池會保持 keep-alive 連線；重試由本類別處理
+        with self._lock:
+            if self._client is None:
+                self._client = openai.OpenAI(api_key=self.api_key, timeout=self.timeout, max_retries=0)
+            return self._client
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _before_call(self):
+        """斷路器開啟時直接拒絕；冷卻時間過後只放行一個試探請求"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.recovery_time and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return
+            self._counters['short_circuited'] += 1
+        raise CircuitOpenError("OpenAI 服務異常，暫停呼叫")
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def _release_trial(self):
+        """放棄試探請求但不改變斷路器狀態（非服務端錯誤無法證明服務已恢復）"""
+        with self._lock:
+            self._trial_in_progress = False
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._trial_in_progress or (self._opened_at is None and self._consecutive_failures >= self.failure_threshold):
+                self._counters['circuit_opened'] += 1
+                self._opened_at = time.monotonic()
+                self._trial_in_progress = False
+                logger.warning(f"OpenAI 連續失敗 {self._consecutive_failures} 次，{self.recovery_time} 秒內暫停呼叫")
+                print(f"[WARNING] OpenAI 連續失敗 {self._consecutive_failures} 次，{self.recovery_time} 秒內暫停呼叫")
+
+    @staticmethod
+    def _is_transient(error):
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    def _retry_delay(self, error, attempt):
+        """優先採用伺服器回傳的 retry-after，否則使用指數退避"""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            if headers.get('retry-after-ms'):
+                return min(float(headers['retry-after-ms']) / 1000, self.max_backoff)
+            if headers.get('retry-after'):
+                return min(float(headers['retry-after']), self.max_backoff)
+        except ValueError:
+            pass
+        return min(self.backoff_base * (2 ** attempt), self.max_backoff)
+
+    def stream_chat(self, cancel=None, **kwargs):
+        """串流取得 chat completion，回傳 (內容, usage, 首個 token 時間)；
+        只在尚未收到任何內容前重試，避免重複的片段。cancel 為 CancelToken，
+        呼叫端放棄等待時取消會關閉串流並釋放併發名額"""
+        self._before_call()
+        if not self._semaphore.acquire(timeout=self.timeout):
+            self._count('rejected')
+            self._release_trial()
+            raise ConcurrencyLimitError(f"同時進行的 OpenAI 請求已達上限 {self.max_concurrency}")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            attempt = 0
+            while True:
+                parts = []
+                usage = None
+                first_token = None
+                try:
+                    if cancel is not None and cancel.cancelled:
+                        raise StreamCancelledError("呼叫端已放棄等待 OpenAI 回覆")
+                    self._count('calls')
+                    stream = self.client.chat.completions.create(stream=True, **kwargs)
+                    close = getattr(stream, 'close', None)
+                    if cancel is not None and close is not None and not cancel.attach(close):
+                        close()
+                        raise StreamCancelledError("呼叫端已放棄等待 OpenAI 回覆")
+                    for chunk in stream:
+                        if cancel is not None and cancel.cancelled:
+                            raise StreamCancelledError("呼叫端已放棄等待 OpenAI 回覆")
+                        if getattr(chunk, 'usage', None):
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if first_token is None:
+                                first_token = time.monotonic()
+                            parts.append(delta)
+                    self._record_success()
+                    return ''.join(parts), usage, first_token
+                except Exception as e:
+                    if cancel is not None and cancel.cancelled:
+                        # 串流被呼叫端關閉造成的錯誤不代表服務異常，不計入斷路器也不重試
+                        self._count('cancelled')
+                        self._release_trial()
+                        if isinstance(e, StreamCancelledError):
+                            raise
+                        raise StreamCancelledError("呼叫端已放棄等待 OpenAI 回覆") from e
+                    transient = self._is_transient(e)
+                    if parts or attempt >= self.max_retries or not transient:
+                        self._count('failures')
+                        # 只有服務端異常（逾時、連線、429、5xx）才計入斷路器
+                        if transient:
+                            self._record_failure()
+                        else:
+                            self._release_trial()
+                        raise
+                    delay = self._retry_delay(e, attempt)
+                    attempt += 1
+                    self._count('retries')
+                    logger.warning(f"OpenAI 暫時性錯誤，{delay} 秒後重試（第 {attempt} 次）: {str(e)}")
+                    print(f"[WARNING] OpenAI 暫時性錯誤，{delay} 秒後重試（第 {attempt} 次）")
+                    if cancel is not None:
+                        cancel.wait(delay)
+                    else:
+                        time.sleep(delay)
+                finally:
+                    if cancel is not None:
+                        cancel.detach()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['in_flight'] = self._in_flight
+            counters['max_concurrency'] = self.max_concurrency
+            counters['circuit'] = 'closed' if self._opened_at is None else ('half_open' if self._trial_in_progress else 'open')
+        return counters
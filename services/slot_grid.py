@@ -0,0 +1,102 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+# 店家所在時區（台灣不使用夏令時間，固定 UTC+8）
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
+# 營業時間與時段間隔
+BUSINESS_OPEN_HOUR = 10
+BUSINESS_CLOSE_HOUR = 20
+SLOT_MINUTES = 30
+
+# 每天的時段數，第 i 個位元代表開門後第 i 個時段
+SLOTS_PER_DAY = (BUSINESS_CLOSE_HOUR - BUSINESS_OPEN_HOUR) * 60 // SLOT_MINUTES
+FULL_DAY_MASK = (1 << SLOTS_PER_DAY) - 1
+_SLOT_START_MINUTES = tuple(BUSINESS_OPEN_HOUR * 60 + index * SLOT_MINUTES for index in range(SLOTS_PER_DAY))
+SLOT_LABELS = tuple(f"{minutes // 60:02d}:{minutes % 60:02d}" for minutes in _SLOT_START_MINUTES)
+SLOT_INDEX = {label: index for index, label in enumerate(SLOT_LABELS)}
+
+def period_mask(start_hour, end_hour):
+    """開始時間落在 [start_hour, end_hour) 的時段遮罩"""
+    mask = 0
+    for index, minutes in enumerate(_SLOT_START_MINUTES):
+        if start_hour * 60 <= minutes < end_hour * 60:
+            mask |= 1 << index
+    return mask
+
+# 早上、下午、晚上的時段遮罩，載入時就算好
+PERIOD_MASKS = {
+    'morning': period_mask(0, 12),
+    'afternoon': period_mask(12, 18),
+    'evening': period_mask(18, 24)
+}
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+def slots_needed(duration_minutes):
+    """服務時長需要佔用的連續時段數"""
+    return max(1, math.ceil(duration_minutes / SLOT_MINUTES))
+
+class DaySlotGrid:
+    """單日的時段位元遮罩：位元為 1 表示該時段（SLOT_MINUTES 分鐘）空閒"""
+    def __init__(self, date, free=FULL_DAY_MASK):
+        self.date = date
+        self.free = free & FULL_DAY_MASK
+
+    @classmethod
+    def from_busy(cls, date, busy):
+        """由忙碌區間 [(開始, 結束), ...]（台北時間，不含時區）建立，與忙碌區間重疊的時段視為不可用"""
+        day_open = datetime.strptime(date, "%Y-%m-%d").replace(hour=BUSINESS_OPEN_HOUR)
+        slot_seconds = SLOT_MINUTES * 60
+        busy_mask = 0
+        for start, end in busy:
+            first = max(0, math.floor((start - day_open).total_seconds() / slot_seconds))
+            last = min(SLOTS_PER_DAY, math.ceil((end - day_open).total_seconds() / slot_seconds))
+            if first < last:
+                busy_mask |= ((1 << (last - first)) - 1) << first
+        return cls(date, FULL_DAY_MASK & ~busy_mask)
+
+    def starts_mask(self, duration_minutes=SLOT_MINUTES):
+        """可容納整段服務時長的開始時段：與右移後的自己逐次 AND，只留下後面連續空閒的位元；
+        超過打烊時間的部分右移後為 0，因此不會排到打烊之後"""
+        mask = self.free
+        for shift in range(1, slots_needed(duration_minutes)):
+            mask &= self.free >> shift
+        return mask
+
+    def is_free(self, time_str):
+        index = SLOT_INDEX.get(time_str)
+        return index is not None and bool(self.free >> index & 1)
+
+    def fits(self, time_str, duration_minutes=SLOT_MINUTES):
+        """從 time_str 開始的服務能否完整排入，不在時段格線上的時間視為不可預約"""
+        index = SLOT_INDEX.get(time_str)
+        if index is None:
+            return False
+        needed = slots_needed(duration_minutes)
+        if index + needed > SLOTS_PER_DAY:
+            return False
+        block = ((1 << needed) - 1) << index
+        return self.free & block == block
+
+    def count(self, mask=None):
+        return popcount(self.free if mask is None else mask)
+
+    def period_counts(self, mask=None):
+        """各時段（早上、下午、晚上）的空閒數量"""
+        mask = self.free if mask is None else mask
+        return {period: popcount(mask & period_bits) for period, period_bits in PERIOD_MASKS.items()}
+
+    def times(self, mask=None, limit=None):
+        """遮罩中的時段轉為 'HH:MM'，依時間先後排列，可只取前 limit 個"""
+        mask = self.free if mask is None else mask
+        labels = []
+        while mask and (limit is None or len(labels) < limit):
+            lowest = mask & -mask
+            labels.append(SLOT_LABELS[lowest.bit_length() - 1])
+            mask ^= lowest
+        return labels
+
+    def __repr__(self):
+        return f"DaySlotGrid({self.date}, {self.free:0{SLOTS_PER_DAY}b})"
@@ -0,0 +1,135 @@
+import threading
+import time
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def _overlaps(start, end, other_start, other_end):
+    return start < other_end and other_start < end
+
+class InMemorySlotHoldStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._holds = {}
+        self._acquired = 0
+        self._conflicts = 0
+
+    def _live_holds_locked(self, key, now):
+        holds = self._holds.get(key, {})
+        for owner in [owner for owner, hold in holds.items() if hold[2] <= now]:
+            del holds[owner]
+        return holds
+
+    def acquire(self, calendar_id, date, start, end, owner, ttl):
+        """保留 [start, end) 時段給 owner，與他人的保留重疊時回傳 False"""
+        key = (calendar_id, date)
+        with self._lock:
+            now = time.monotonic()
+            holds = self._live_holds_locked(key, now)
+            for other, (other_start, other_end, _) in holds.items():
+                if other != owner and _overlaps(start, end, other_start, other_end):
+                    self._conflicts += 1
+                    return False
+            # 每位用戶同時只保留一個時段
+            for other_key, other_holds in self._holds.items():
+                if other_key != key:
+                    other_holds.pop(owner, None)
+            self._holds.setdefault(key, {})[owner] = (start, end, now + ttl)
+            self._acquired += 1
+            return True
+
+    def release(self, calendar_id, date, owner):
+        """釋放 owner 在指定日期的保留"""
+        with self._lock:
+            holds = self._holds.get((calendar_id, date))
+            if holds:
+                holds.pop(owner, None)
+                if not holds:
+                    del self._holds[(calendar_id, date)]
+
+    def is_held_by(self, calendar_id, date, start, end, owner):
+        """owner 目前是否仍保留著這個時段"""
+        with self._lock:
+            hold = self._live_holds_locked((calendar_id, date), time.monotonic()).get(owner)
+            return hold is not None and hold[0] == start and hold[1] == end
+
+    def held_intervals(self, calendar_id, date, exclude_owner=None):
+        """其他用戶在指定日期保留中的區間"""
+        with self._lock:
+            holds = self._live_holds_locked((calendar_id, date), time.monotonic())
+            return [(start, end) for owner, (start, end, _) in holds.items() if owner != exclude_owner]
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            active = sum(len(self._live_holds_locked(key, now)) for key in list(self._holds))
+            return {'backend': 'memory', 'active_holds': active, 'acquired': self._acquired, 'conflicts': self._conflicts}
+
+class FirestoreSlotHoldStore:
+    def __init__(self, db, collection='slot_holds'):
+        self.db = db
+        self.collection = collection
+
+    def _doc(self, calendar_id, date):
+        return self.db.collection(self.collection).document(f"{calendar_id}_{date}")
+
+    def _owner_doc(self, owner):
+        """記錄 owner 目前保留在哪一天，確保每位用戶同時只保留一個時段"""
+        return self.db.collection(f"{self.collection}_owners").document(owner)
+
+    @staticmethod
+    def _live_holds(snapshot, now):
+        holds = (snapshot.to_dict() or {}).get('holds', {}) if snapshot.exists else {}
+        return {owner: hold for owner, hold in holds.items() if hold['expires_at'] > now}
+
+    def acquire(self, calendar_id, date, start, end, owner, ttl):
+        """以 Firestore 交易保留時段，可跨多個行程共用"""
+        from firebase_admin import firestore
+        doc_ref = self._doc(calendar_id, date)
+        owner_ref = self._owner_doc(owner)
+        start_str, end_str = start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+
+        @firestore.transactional
+        def _acquire(transaction):
+            now = time.time()
+            # 交易中所有讀取必須在寫入之前
+            holds = self._live_holds(doc_ref.get(transaction=transaction), now)
+            previous = owner_ref.get(transaction=transaction)
+            previous = (previous.to_dict() or {}) if previous.exists else {}
+            previous_ref = None
+            if previous.get('calendar_id') is not None and (previous['calendar_id'], previous.get('date')) != (calendar_id, date):
+                previous_ref = self._doc(previous['calendar_id'], previous['date'])
+                previous_holds = self._live_holds(previous_ref.get(transaction=transaction), now)
+
+            for other, hold in holds.items():
+                if other != owner and hold['start'] < end_str and start_str < hold['end']:
+                    return False
+            # 換日期時在同一個交易中釋放原本的保留
+            if previous_ref is not None and owner in previous_holds:
+                del previous_holds[owner]
+                transaction.set(previous_ref, {'holds': previous_holds})
+            holds[owner] = {'start': start_str, 'end': end_str, 'expires_at': now + ttl}
+            transaction.set(doc_ref, {'holds': holds})
+            transaction.set(owner_ref, {'calendar_id': calendar_id, 'date': date})
+            return True
+
+        return _acquire(self.db.transaction())
+
+    def release(self, calendar_id, date, owner):
+        """釋放 owner 在指定日期的保留"""
+        from firebase_admin import firestore
+        self._doc(calendar_id, date).set({'holds': {owner: firestore.DELETE_FIELD}}, merge=True)
+
+    def is_held_by(self, calendar_id, date, start, end, owner):
+        hold = self._live_holds(self._doc(calendar_id, date).get(), time.time()).get(owner)
+        return bool(hold) and hold['start'] == start.strftime(TIME_FORMAT) and hold['end'] == end.strftime(TIME_FORMAT)
+
+    def held_intervals(self, calendar_id, date, exclude_owner=None):
+        holds = self._live_holds(self._doc(calendar_id, date).get(), time.time())
+        return [
+            (datetime.strptime(hold['start'], TIME_FORMAT), datetime.strptime(hold['end'], TIME_FORMAT))
+            for owner, hold in holds.items() if owner != exclude_owner
+        ]
+
+    def stats(self):
+        return {'backend': 'firestore', 'collection': self.collection}
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _get_live_entry(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _store(self, key, value, ttl, now):
+        self._data[key] = (value, now + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self._evictions += 1
+
+    def get(self, key, default=None):
+        """取得快取內容，過期或不存在時回傳 default"""
+        with self._lock:
+            entry = self._get_live_entry(key, time.monotonic())
+            if entry is None:
+                self._misses += 1
+                return default
+            self._data.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """取得快取內容但不計入命中統計、不調整淘汰順序"""
+        with self._lock:
+            entry = self._get_live_entry(key, time.monotonic())
+            return default if entry is None else entry[0]
+
+    def replace(self, key, func):
+        """在鎖內以 func(舊值) 的結果取代未過期的項目（保留原本的到期時間），回傳是否有取代"""
+        with self._lock:
+            entry = self._get_live_entry(key, time.monotonic())
+            if entry is None:
+                return False
+            self._data[key] = (func(entry[0]), entry[1])
+            return True
+
+    def set(self, key, value, ttl=None):
+        """寫入快取，超過容量時淘汰最久未使用的項目"""
+        with self._lock:
+            self._store(key, value, ttl, time.monotonic())
+
+    def add(self, key, value, ttl=None):
+        """僅在 key 不存在（或已過期）時寫入，回傳是否寫入成功"""
+        with self._lock:
+            now = time.monotonic()
+            if self._get_live_entry(key, now) is not None:
+                self._data.move_to_end(key)
+                return False
+            self._store(key, value, ttl, now)
+            return True
+
+    def pop(self, key, default=None):
+        """移除快取項目"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def items(self):
+        """回傳所有未過期項目的 (key, value, 剩餘秒數)，供持久化使用"""
+        with self._lock:
+            now = time.monotonic()
+            return [(key, value, expires - now) for key, (value, expires) in self._data.items() if expires > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """回傳命中率等統計資訊"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,103 @@
+import threading
+import logging
+import traceback
+from collections import deque, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class UserMailboxExecutor:
+    def __init__(self, worker_pool, max_mailbox_size=50, max_tracked_users=10000):
+        self.worker_pool = worker_pool
+        self.max_mailbox_size = max_mailbox_size
+        self.max_tracked_users = max_tracked_users
+        self._lock = threading.Lock()
+        self._mailboxes = {}
+        self._active = set()
+        self._last_timestamps = OrderedDict()
+        self._processed = 0
+        self._failed = 0
+        self._dropped_stale = 0
+        self._dropped_overflow = 0
+        self._rejected_busy = 0
+
+    def submit(self, key, timestamp, func, *args):
+        """投遞事件到用戶信箱：同一用戶依序處理，不同用戶平行處理。
+        信箱已滿或工作池無法再接手時回傳 False，事件一律不在呼叫端的執行緒處理"""
+        if key is None:
+            # 無法識別用戶的事件不需要排序，直接交給工作池
+            if self.worker_pool.submit(func, *args):
+                return True
+            with self._lock:
+                self._rejected_busy += 1
+            return False
+
+        with self._lock:
+            mailbox = self._mailboxes.setdefault(key, deque())
+            if len(mailbox) >= self.max_mailbox_size:
+                self._dropped_overflow += 1
+                logger.warning(f"用戶 {key} 的信箱已滿 ({self.max_mailbox_size})，捨棄新事件")
+                print(f"[WARNING] 用戶 {key} 的信箱已滿 ({self.max_mailbox_size})，捨棄新事件")
+                return False
+            if key in self._active:
+                # 已有工作執行緒負責此信箱，排隊即可
+                mailbox.append((timestamp, func, args))
+                return True
+            # 排入工作池與標記為處理中在同一段鎖內完成，同一信箱不會有兩個工作執行緒
+            if not self.worker_pool.submit(self._drain, key):
+                if not mailbox:
+                    del self._mailboxes[key]
+                self._rejected_busy += 1
+                logger.warning(f"工作池已滿，無法處理用戶 {key} 的新事件")
+                print(f"[WARNING] 工作池已滿，無法處理用戶 {key} 的新事件")
+                return False
+            mailbox.append((timestamp, func, args))
+            self._active.add(key)
+        return True
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                mailbox = self._mailboxes.get(key)
+                if not mailbox:
+                    self._mailboxes.pop(key, None)
+                    self._active.discard(key)
+                    return
+                timestamp, func, args = mailbox.popleft()
+                last_timestamp = self._last_timestamps.get(key)
+                if timestamp is not None and last_timestamp is not None and timestamp < last_timestamp:
+                    self._dropped_stale += 1
+                    logger.info(f"捨棄用戶 {key} 的過期事件: {timestamp} < {last_timestamp}")
+                    continue
+                if timestamp is not None:
+                    self._last_timestamps[key] = timestamp
+                    self._last_timestamps.move_to_end(key)
+                    if len(self._last_timestamps) > self.max_tracked_users:
+                        self._last_timestamps.popitem(last=False)
+
+            try:
+                func(*args)
+                with self._lock:
+                    self._processed += 1
+            except Exception as e:
+                with self._lock:
+                    self._processed += 1
+                    self._failed += 1
+                logger.error(f"處理用戶 {key} 的事件失敗: {str(e)}\n{traceback.format_exc()}")
+                print(f"[ERROR] 處理用戶 {key} 的事件失敗: {str(e)}")
+
+    def stats(self, top_n=20):
+        """回傳各信箱待處理數量與捨棄統計"""
+        with self._lock:
+            backlog = {key: len(mailbox) for key, mailbox in self._mailboxes.items()}
+            busiest = sorted(backlog.items(), key=lambda item: item[1], reverse=True)[:top_n]
+            return {
+                'active_mailboxes': len(self._active),
+                'total_backlog': sum(backlog.values()),
+                'max_backlog': max(backlog.values()) if backlog else 0,
+                'mailbox_backlog': dict(busiest),
+                'processed': self._processed,
+                'failed': self._failed,
+                'dropped_stale': self._dropped_stale,
+                'dropped_overflow': self._dropped_overflow,
+                'rejected_busy': self._rejected_busy
+            }
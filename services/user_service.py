@@ -1,16 +1,99 @@
+import copy
 from datetime import datetime
+from services.ttl_cache import TTLCache
+
+# 對話進行中的欄位，可能被其他行程修改，每次都從 Firestore 讀取，不放進快取
+CONVERSATION_FIELDS = ('state', 'booking_date', 'booking_time', 'selected_service', 'last_interaction', 'conversation')
+
+def _profile_fields(user_data):
+    """去除對話欄位，只留下可快取的個人資料"""
+    return {key: copy.deepcopy(value) for key, value in user_data.items() if key not in CONVERSATION_FIELDS}
+
+def _state_fields(state, booking_date='', booking_time='', selected_service=None):
+    """組合狀態與暫存預約資訊的欄位"""
+    update = {'state': state}
+    if booking_date is not None:
+        update['booking_date'] = booking_date
+    if booking_time is not None:
+        update['booking_time'] = booking_time
+    if selected_service is not None:
+        update['selected_service'] = selected_service
+    return update
+
+class UserSession:
+    """單一 webhook 事件的用戶資料工作單元：變更先累積在記憶體，事件結束時一次寫回"""
+    def __init__(self, user_service, user_id, user_info):
+        self.user_service = user_service
+        self.user_id = user_id
+        self._data = dict(user_info or {})
+        self._changes = {}
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def to_dict(self):
+        return dict(self._data)
+
+    def __repr__(self):
+        # 記錄日誌時顯示用戶資料內容
+        return repr(self._data)
+
+    @property
+    def pending_changes(self):
+        return dict(self._changes)
+
+    def update(self, user_data):
+        """暫存欄位變更，讀取時立即反映"""
+        self._data.update(user_data)
+        self._changes.update(user_data)
+
+    def set_state(self, state, booking_date='', booking_time='', selected_service=None):
+        """設定用戶狀態與暫存預約資訊"""
+        self.update(_state_fields(state, booking_date, booking_time, selected_service))
+
+    def mark_saved(self, user_data):
+        """外部已將 user_data 連同暫存變更一併寫入，清空待寫入的變更"""
+        self._data.update(user_data)
+        self._changes = {}
+
+    def flush(self):
+        """將累積的變更以一次 update 寫回，沒有變更時不寫入"""
+        if not self._changes:
+            return False
+        changes = self._changes
+        self._changes = {}
+        self.user_service.update_user_info(self.user_id, changes)
+        return True
 
 class UserService:
-    def __init__(self, firebase_service):
+    def __init__(self, firebase_service, cache_size=1000, cache_ttl=300):
         self.firebase_service = firebase_service
+        # 個人資料快取（姓名、電話、常用服務等），對話狀態不快取，多個行程部署時不會讀到舊的狀態
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
 
     def get_user_info(self, user_id):
         """獲取用戶資訊，如果不存在則創建新用戶"""
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            # 快取命中時只讀取對話欄位
+            conversation = self.firebase_service.get_user_fields(user_id, CONVERSATION_FIELDS)
+            if conversation is not None:
+                user_info = copy.deepcopy(profile)
+                user_info.update(conversation)
+                return user_info
+            self.cache.pop(user_id)
+
         user_info = self.firebase_service.get_user(user_id)
         
         if not user_info:
-            # 創建新用戶
-            self.firebase_service.create_user(user_id, {
+            # 創建新用戶，直接使用寫入的內容而不再讀取一次
+            user_info = self.firebase_service.create_user(user_id, {
                 'name': '',
                 'phone': '',
                 'favorite_services': [],
@@ -18,32 +101,54 @@ class UserService:
                 'booking_date': '',
                 'booking_time': ''
             })
-            user_info = self.firebase_service.get_user(user_id)
         
+        self.cache.set(user_id, _profile_fields(user_info))
         return user_info
 
+    def _merge_cached(self, user_id, user_data):
+        # 合併到新的 dict 再替換，其他執行緒正在複製的舊 dict 不會被修改
+        profile = _profile_fields(user_data)
+        self.cache.replace(user_id, lambda cached: dict(cached, **profile))
+
+    def open_session(self, user_id):
+        """讀取一次用戶資料並建立本次事件的工作單元"""
+        return UserSession(self, user_id, self.get_user_info(user_id))
+
     def update_user_info(self, user_id, user_data):
         """更新用戶資訊"""
         self.firebase_service.update_user(user_id, user_data)
+        self._merge_cached(user_id, user_data)
 
     def set_state(self, user_id, state, booking_date='', booking_time='', selected_service=None):
         """設定用戶狀態與暫存預約資訊"""
-        update = {'state': state}
-        if booking_date is not None:
-            update['booking_date'] = booking_date
-        if booking_time is not None:
-            update['booking_time'] = booking_time
-        if selected_service is not None:
-            update['selected_service'] = selected_service
-        self.update_user_info(user_id, update)
+        self.update_user_info(user_id, _state_fields(state, booking_date, booking_time, selected_service))
 
     def add_booking(self, user_id, booking_data):
         """添加預約記錄"""
         self.firebase_service.add_booking_history(user_id, booking_data)
+        self._merge_cached(user_id, {'last_booking': booking_data['start_time']})
+
+    def commit_booking(self, session, booking_data):
+        """將預約記錄、last_booking、重置後的對話狀態與 session 的暫存變更一次寫入"""
+        user_data = session.pending_changes
+        user_data.update(_state_fields('', selected_service=''))
+        # 只保留摘要，日曆事件 ID 與連結留在預約記錄中
+        user_data['last_booking'] = {key: booking_data.get(key) for key in ('service', 'start_time', 'end_time')}
+        self.firebase_service.commit_booking(session.user_id, booking_data, user_data)
+        session.mark_saved(user_data)
+        self._merge_cached(session.user_id, user_data)
+
+    def get_booking_history(self, user_id, limit=20, cursor=None):
+        """分頁獲取用戶預約歷史，回傳 (預約列表, 下一頁游標)"""
+        return self.firebase_service.get_booking_history(user_id, limit=limit, cursor=cursor)
+
+    def iter_booking_history(self, user_id, page_size=100):
+        """逐頁讀取全部預約歷史"""
+        return self.firebase_service.iter_booking_history(user_id, page_size=page_size)
 
-    def get_booking_history(self, user_id):
-        """獲取用戶預約歷史"""
-        return self.firebase_service.get_booking_history(user_id)
+    def get_latest_bookings(self, user_id, n=1):
+        """獲取最新的 n 筆預約"""
+        return self.firebase_service.get_latest_bookings(user_id, n)
 
     def update_favorite_services(self, user_id, service):
         """更新用戶常用服務"""
@@ -0,0 +1,83 @@
+import threading
+import time
+from datetime import datetime
+from services.calendar_mirror import CalendarMirror
+from services.calendar_replica import SqliteCalendarMirror
+from services.calendar_service import GoogleCalendarService
+
+class Request:
+    def __init__(self, run):
+        self.run = run
+
+    def execute(self):
+        return self.run()
+
+class FakeEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        def run():
+            self.service.list_calls += 1
+            time.sleep(0.05)
+            return {'items': [], 'nextSyncToken': 'token'}
+        return Request(run)
+
+class FakeGoogleService:
+    """只提供鏡像同步用到的 events().list，記錄呼叫次數"""
+    def __init__(self):
+        self.list_calls = 0
+
+    def events(self):
+        return FakeEvents(self)
+
+def make_service(monkeypatch):
+    monkeypatch.setenv('CALENDAR_SYNC_MODE', 'mirror')
+    monkeypatch.delenv('CALENDAR_REPLICA_PATH', raising=False)
+    calendar = object.__new__(GoogleCalendarService)
+    calendar.service = FakeGoogleService()
+    calendar.calendar_id = 'cal'
+    calendar._init_availability_state()
+    return calendar
+
+def test_concurrent_readers_of_a_stale_mirror_sync_once(monkeypatch):
+    calendar = make_service(monkeypatch)
+    threads = [threading.Thread(target=calendar._ensure_mirror_fresh) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calendar.service.list_calls == 1
+
+def test_dirty_mirror_syncs_again(monkeypatch):
+    calendar = make_service(monkeypatch)
+    calendar._ensure_mirror_fresh()
+    calendar.mark_mirror_dirty()
+    calendar._ensure_mirror_fresh()
+    assert calendar.service.list_calls == 2
+
+def test_prune_drops_past_events_from_both_mirrors(tmp_path):
+    events = {
+        'old': (datetime(2025, 5, 1, 10), datetime(2025, 5, 1, 11), '舊預約'),
+        'new': (datetime(2025, 5, 3, 14), datetime(2025, 5, 3, 16), '新預約')
+    }
+    cutoff = datetime(2025, 5, 2)
+    for mirror in (CalendarMirror(), SqliteCalendarMirror(str(tmp_path / 'replica.db'), 'cal')):
+        mirror.replace_all(events, 'token')
+        assert mirror.prune_before(cutoff) == 1
+        assert mirror.busy_on('2025-05-01') == []
+        assert mirror.busy_on('2025-05-03') == [(events['new'][0], events['new'][1])]
+        assert mirror.stats()['events'] == 1
+
+def test_replica_finds_long_events_with_a_bounded_scan(tmp_path):
+    path = str(tmp_path / 'replica.db')
+    replica = SqliteCalendarMirror(path, 'cal')
+    replica.replace_all({'short': (datetime(2025, 5, 3, 10), datetime(2025, 5, 3, 11), '美甲')}, 'token')
+    # 跨三天的休假事件開始時間早於查詢範圍很多
+    replica.apply_changes({'leave': (datetime(2025, 5, 1, 10), datetime(2025, 5, 4, 20), '店休')}, [], 'token2')
+    assert replica.busy_between(datetime(2025, 5, 4), datetime(2025, 5, 5)) == [
+        (datetime(2025, 5, 1, 10), datetime(2025, 5, 4, 20))
+    ]
+    # 重新開啟副本時由既有資料算出最長事件長度
+    reopened = SqliteCalendarMirror(path, 'cal')
+    assert len(reopened.busy_between(datetime(2025, 5, 3), datetime(2025, 5, 4))) == 2
@@ -0,0 +1,88 @@
+from services.chatgpt_service import ChatGPTService
+from services.conversation_memory import ConversationMemory
+from services.user_service import UserSession
+
+class FakeClient:
+    """取代 OpenAIClient，記錄呼叫次數並回傳固定內容"""
+    def __init__(self, reply="我們的營業時間是每天 10:00 到 20:00 喔！😊"):
+        self.reply = reply
+        self.calls = []
+
+    def stream_chat(self, model, messages, **kwargs):
+        self.calls.append(messages)
+        return self.reply, None, None
+
+    def stats(self):
+        return {}
+
+def chat(service, memory, session, message):
+    """與 app.handle_chat 相同：帶入對話記憶呼叫 ChatGPT，再記錄這次對話"""
+    response = service.process_message(message, user_info=session, history=memory.to_messages(session))
+    memory.record(session, message, response)
+    return response
+
+def test_faq_after_greeting_is_served_from_cache():
+    client = FakeClient()
+    service = ChatGPTService(client=client)
+    memory = ConversationMemory()
+
+    first = UserSession(None, 'user-a', {'name': '小美', 'state': ''})
+    assert chat(service, memory, first, "營業時間到幾點？") == client.reply
+    assert len(client.calls) == 1
+
+    # 打招呼由固定回覆處理，不寫入對話記憶
+    second = UserSession(None, 'user-b', {'name': '小華', 'state': ''})
+    assert memory.to_messages(second) == []
+    assert chat(service, memory, second, "營業時間到幾點") == client.reply
+    assert len(client.calls) == 1
+    assert service.stats()['response_cache']['hits'] == 1
+
+def test_follow_up_with_history_skips_cache():
+    client = FakeClient()
+    service = ChatGPTService(client=client)
+    memory = ConversationMemory()
+    session = UserSession(None, 'user-a', {'name': '小美', 'state': ''})
+
+    chat(service, memory, session, "營業時間到幾點？")
+    chat(service, memory, session, "營業時間到幾點？")
+    assert len(client.calls) == 2
+    # 第二次呼叫帶有先前的對話
+    assert {'role': 'user', 'content': "營業時間到幾點？"} in client.calls[1]
+
+def test_reply_mentioning_booking_history_is_not_shared():
+    client = FakeClient(reply="上次的凝膠美甲還喜歡嗎？這次也可以試試看手部保養喔！")
+    service = ChatGPTService(client=client)
+    session = UserSession(None, 'user-a', {
+        'name': '小美',
+        'state': '',
+        'favorite_services': ['凝膠美甲'],
+        'last_booking': {'service': '凝膠美甲', 'start_time': '2025-05-03T14:00:00'}
+    })
+
+    service.process_message("有推薦的服務嗎", user_info=session)
+    other = UserSession(None, 'user-b', {'name': '小華', 'state': ''})
+    service.process_message("有推薦的服務嗎", user_info=other)
+    assert len(client.calls) == 2
+    assert service.stats()['response_cache']['uncacheable'] == 1
+
+def test_cache_key_separates_conversation_states():
+    client = FakeClient(reply="好的～")
+    service = ChatGPTService(client=client)
+
+    service.process_message("好喔", user_info=UserSession(None, 'user-a', {'name': '小美', 'state': ''}))
+    service.process_message("好喔", user_info=UserSession(None, 'user-b', {'name': '小華', 'state': 'booking_ask_date'}))
+    assert len(client.calls) == 2
+
+def test_prompt_only_carries_booking_summary():
+    client = FakeClient()
+    service = ChatGPTService(client=client)
+    session = UserSession(None, 'user-a', {
+        'name': '小美',
+        'state': '',
+        'last_booking': {'service': '凝膠美甲', 'start_time': '2025-05-03T14:00:00', 'end_time': '2025-05-03T16:00:00'}
+    })
+
+    service.process_message("謝謝", user_info=session, use_cache=False)
+    context = next(m['content'] for m in client.calls[0] if m['content'].startswith('用戶資訊'))
+    assert '上次預約：2025-05-03 14:00 凝膠美甲' in context
+    assert '{' not in context
@@ -0,0 +1,46 @@
+import random
+from datetime import date, timedelta
+from services.datetime_parser import parse_datetime
+
+TODAY = date(2025, 12, 20)
+WEEKDAY_NAMES = "一二三四五六日"
+
+def render_time(hour, minute, rng):
+    """把 24 小時制的營業時間隨機寫成用戶可能的說法"""
+    if minute == 30 and rng.random() < 0.5:
+        twelve = hour - 12 if hour > 12 else hour
+        prefix = '下午' if hour >= 12 and rng.random() < 0.5 else ''
+        return f"{prefix}{twelve}點半"
+    if rng.random() < 0.5:
+        return f"{hour}:{minute:02d}"
+    twelve = hour - 12 if hour > 12 else hour
+    period = rng.choice(['下午', '晚上']) if hour >= 13 else ('上午' if hour < 12 else '')
+    suffix = f"{minute}分" if minute else ''
+    return f"{period}{twelve}點{suffix}"
+
+def render_date(target, rng):
+    """把日期寫成 月/日、含年份、相對日期或星期的說法"""
+    offset = (target - TODAY).days
+    choices = [f"{target.month}/{target.day}", f"{target.year}-{target.month:02d}-{target.day:02d}",
+               f"{target.month}月{target.day}日"]
+    if offset in (0, 1, 2):
+        choices.append(['今天', '明天', '後天'][offset])
+    if 0 <= offset < 7:
+        choices.append(f"週{WEEKDAY_NAMES[target.weekday()]}")
+    return rng.choice(choices)
+
+def test_random_dates_and_times_round_trip():
+    """隨機產生日期與營業時間的各種寫法，解析結果必須還原成原本的值"""
+    rng = random.Random(7)
+    for _ in range(5000):
+        target = TODAY + timedelta(days=rng.randint(0, 360))
+        hour = rng.randint(10, 19)
+        minute = rng.choice([0, 30])
+        text = f"{render_date(target, rng)} {render_time(hour, minute, rng)}"
+        result = parse_datetime(text, today=TODAY)
+        expected = {'date': target.strftime("%Y-%m-%d"), 'time': f"{hour:02d}:{minute:02d}"}
+        assert result == expected, text
+
+def test_month_before_today_rolls_over_to_next_year():
+    # 12 月時輸入 1 月的日期應解析為明年
+    assert parse_datetime("1/5", today=TODAY)['date'] == "2026-01-05"
@@ -0,0 +1,86 @@
+import threading
+import time
+from types import SimpleNamespace
+import openai
+import pytest
+from services.chatgpt_service import ChatGPTService
+from services.openai_client import OpenAIClient
+
+# 只提供例外建構時讀取的屬性，不依賴特定的 HTTP 函式庫
+REQUEST = SimpleNamespace(method='POST', url='https://api.openai.com/v1/chat/completions')
+
+class FakeCompletions:
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+
+    def create(self, **kwargs):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome if hasattr(outcome, 'close') else iter(outcome)
+
+class FakeOpenAI:
+    def __init__(self, outcomes):
+        self.chat = type('Chat', (), {})()
+        self.chat.completions = FakeCompletions(outcomes)
+
+def make_client(outcomes, **kwargs):
+    client = OpenAIClient(api_key='test', max_retries=0, **kwargs)
+    client._client = FakeOpenAI(outcomes)
+    return client
+
+def bad_request():
+    return openai.BadRequestError('bad request', response=SimpleNamespace(request=REQUEST, status_code=400, headers={}), body=None)
+
+def test_non_transient_error_in_trial_keeps_circuit_open():
+    client = make_client([openai.APIConnectionError(request=REQUEST), bad_request()],
+                         failure_threshold=1, recovery_time=0)
+    with pytest.raises(openai.APIConnectionError):
+        client.stream_chat(model='m', messages=[])
+    assert client.stats()['circuit'] == 'open'
+
+    # 試探請求遇到 400 錯誤：不能證明服務恢復，斷路器維持開啟但可再次試探
+    with pytest.raises(openai.BadRequestError):
+        client.stream_chat(model='m', messages=[])
+    assert client.stats()['circuit'] == 'open'
+    assert client._trial_in_progress is False
+
+def test_non_transient_error_does_not_reset_failure_count():
+    client = make_client([openai.APIConnectionError(request=REQUEST), bad_request(),
+                          openai.APIConnectionError(request=REQUEST)], failure_threshold=2)
+    for error in (openai.APIConnectionError, openai.BadRequestError, openai.APIConnectionError):
+        with pytest.raises(error):
+            client.stream_chat(model='m', messages=[])
+    assert client.stats()['circuit'] == 'open'
+
+class BlockingStream:
+    """第一個片段前一直阻塞，直到被 close() 關閉"""
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def __iter__(self):
+        self.closed.wait(5)
+        raise openai.APIConnectionError(request=REQUEST)
+
+def chunk(text):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+def test_abandoned_stream_is_closed_and_releases_its_slot():
+    stream = BlockingStream()
+    client = make_client([stream, [chunk("好的～")]], max_concurrency=1)
+    service = ChatGPTService(client=client, request_timeout=0.2)
+
+    assert service.process_message("你好", use_cache=False) == service.fallback_message
+    assert stream.closed.wait(1)
+    deadline = time.monotonic() + 1
+    while client.stats()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = client.stats()
+    assert stats['in_flight'] == 0
+    assert stats['cancelled'] == 1
+    assert stats['circuit'] == 'closed'
+    # 唯一的併發名額已釋放，下一次呼叫不必等待
+    assert client.stream_chat(model='m', messages=[])[0] == "好的～"
@@ -0,0 +1,120 @@
+import copy
+from datetime import datetime
+import pytest
+from firebase_admin import firestore
+from services.slot_hold import InMemorySlotHoldStore, FirestoreSlotHoldStore
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self):
+        return self._data
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self.db.docs.get(self.path))
+
+    def set(self, data, merge=False):
+        self.db.write(self.path, data, merge)
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id):
+        return FakeDocument(self.db, (self.name, doc_id))
+
+class FakeTransaction:
+    """提供 firestore.transactional 會呼叫的方法，寫入在 commit 時才套用"""
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db):
+        self.db = db
+        self._id = None
+        self._writes = []
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = b'fake-transaction'
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref.path, data, merge))
+
+    def _commit(self):
+        for path, data, merge in self._writes:
+            self.db.write(path, data, merge)
+        self._clean_up()
+        return []
+
+    def _rollback(self):
+        self._clean_up()
+
+class FakeFirestore:
+    """以字典模擬 Firestore 的文件讀寫"""
+    def __init__(self):
+        self.docs = {}
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    @staticmethod
+    def _merge(target, data):
+        for key, value in data.items():
+            if value is firestore.DELETE_FIELD:
+                target.pop(key, None)
+            elif isinstance(value, dict) and isinstance(target.get(key), dict):
+                FakeFirestore._merge(target[key], value)
+            else:
+                target[key] = copy.deepcopy(value)
+
+    def write(self, path, data, merge):
+        if merge:
+            self._merge(self.docs.setdefault(path, {}), data)
+        else:
+            self.docs[path] = copy.deepcopy(data)
+
+def slot(date, hour):
+    return datetime.strptime(f"{date} {hour:02d}:00", "%Y-%m-%d %H:%M"), datetime.strptime(f"{date} {hour + 1:02d}:00", "%Y-%m-%d %H:%M")
+
+@pytest.fixture(params=['memory', 'firestore'])
+def store(request):
+    if request.param == 'memory':
+        return InMemorySlotHoldStore()
+    return FirestoreSlotHoldStore(FakeFirestore())
+
+def test_changing_dates_releases_the_previous_hold(store):
+    first = slot('2025-05-03', 14)
+    second = slot('2025-05-04', 10)
+
+    assert store.acquire('cal', '2025-05-03', *first, 'alice', 300)
+    assert not store.acquire('cal', '2025-05-03', *first, 'bob', 300)
+
+    # alice 改選另一天：原本的保留立即釋放，其他人可以預約
+    assert store.acquire('cal', '2025-05-04', *second, 'alice', 300)
+    assert not store.is_held_by('cal', '2025-05-03', *first, 'alice')
+    assert store.held_intervals('cal', '2025-05-03') == []
+    assert store.acquire('cal', '2025-05-03', *first, 'bob', 300)
+
+    assert store.held_intervals('cal', '2025-05-04', exclude_owner='bob') == [second]
+    assert store.is_held_by('cal', '2025-05-04', *second, 'alice')
+
+def test_release_then_reacquire_on_same_date(store):
+    first = slot('2025-05-03', 14)
+    assert store.acquire('cal', '2025-05-03', *first, 'alice', 300)
+    store.release('cal', '2025-05-03', 'alice')
+    assert store.held_intervals('cal', '2025-05-03') == []
+    assert store.acquire('cal', '2025-05-03', *first, 'bob', 300)
@@ -0,0 +1,90 @@
+import threading
+import time
+from services.user_mailbox import UserMailboxExecutor
+
+class ManualPool:
+    """容量固定的工作池，工作由測試手動執行，saturated 時拒絕新工作"""
+    def __init__(self, capacity=10):
+        self.capacity = capacity
+        self.jobs = []
+
+    def submit(self, func, *args):
+        if len(self.jobs) >= self.capacity:
+            return False
+        self.jobs.append((func, args))
+        return True
+
+    def run_all(self):
+        while self.jobs:
+            func, args = self.jobs.pop(0)
+            func(*args)
+
+def recorder():
+    handled = []
+
+    def handle(name):
+        handled.append((name, threading.current_thread().name))
+    return handled, handle
+
+def test_saturated_pool_rejects_without_running_on_caller_thread():
+    pool = ManualPool(capacity=0)
+    executor = UserMailboxExecutor(pool)
+    handled, handle = recorder()
+
+    assert executor.submit('u1', 1, handle, 'first') is False
+    assert executor.submit('u1', 2, handle, 'second') is False
+    assert executor.submit(None, None, handle, 'anonymous') is False
+    assert handled == []
+    assert executor.stats()['rejected_busy'] == 3
+    assert executor.stats()['active_mailboxes'] == 0
+
+    # 工作池空出來後同一用戶可以再次投遞
+    pool.capacity = 1
+    assert executor.submit('u1', 3, handle, 'third') is True
+    pool.run_all()
+    assert [name for name, _ in handled] == ['third']
+
+def test_events_queue_behind_active_drainer_while_pool_is_saturated():
+    pool = ManualPool(capacity=1)
+    executor = UserMailboxExecutor(pool)
+    handled, handle = recorder()
+
+    assert executor.submit('u1', 1, handle, 'first') is True
+    # 工作池已滿，但 u1 已有排定的工作執行緒，後續事件排在同一信箱
+    assert executor.submit('u1', 2, handle, 'second') is True
+    assert executor.submit('u1', 3, handle, 'third') is True
+    assert executor.submit('u2', 1, handle, 'other') is False
+    assert handled == []
+    assert len(pool.jobs) == 1
+
+    pool.run_all()
+    assert [name for name, _ in handled] == ['first', 'second', 'third']
+    assert executor.stats()['active_mailboxes'] == 0
+
+def test_per_user_order_with_real_workers():
+    from services.event_worker_pool import EventWorkerPool
+    pool = EventWorkerPool(num_workers=4, max_queue_size=4)
+    executor = UserMailboxExecutor(pool, max_mailbox_size=1000)
+    lock = threading.Lock()
+    running = set()
+    handled = {}
+
+    def handle(key, index):
+        with lock:
+            assert key not in running
+            running.add(key)
+        with lock:
+            running.discard(key)
+            handled.setdefault(key, []).append(index)
+
+    accepted = {}
+    for index in range(2000):
+        key = f"u{index % 10}"
+        if executor.submit(key, index, handle, key, index):
+            accepted.setdefault(key, []).append(index)
+
+    deadline = time.monotonic() + 10
+    while executor.stats()['active_mailboxes'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for key, indexes in accepted.items():
+        assert handled.get(key) == indexes
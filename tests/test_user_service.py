@@ -0,0 +1,63 @@
+import copy
+from services.user_service import UserService
+
+class FakeFirebase:
+    """以字典模擬 Firestore 的 users 集合，多個 UserService 共用時相當於多個行程"""
+    def __init__(self):
+        self.users = {}
+        self.reads = []
+
+    def get_user(self, user_id):
+        self.reads.append((user_id, None))
+        user = self.users.get(user_id)
+        return copy.deepcopy(user) if user is not None else None
+
+    def get_user_fields(self, user_id, field_paths):
+        self.reads.append((user_id, tuple(field_paths)))
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        return {key: copy.deepcopy(user[key]) for key in field_paths if key in user}
+
+    def create_user(self, user_id, user_data):
+        self.users[user_id] = dict(user_data, last_booking=None)
+        return copy.deepcopy(self.users[user_id])
+
+    def update_user(self, user_id, user_data):
+        self.users[user_id].update(copy.deepcopy(user_data))
+
+def test_conversation_state_written_by_another_worker_is_seen():
+    firebase = FakeFirebase()
+    firebase.users['u1'] = {'name': '小美', 'phone': '0912345678', 'state': ''}
+    worker_a = UserService(firebase)
+    worker_b = UserService(firebase)
+
+    assert worker_a.get_user_info('u1')['state'] == ''
+    worker_b.set_state('u1', 'booking_ask_time', booking_date='2025-05-03')
+
+    user_info = worker_a.get_user_info('u1')
+    assert user_info['state'] == 'booking_ask_time'
+    assert user_info['booking_date'] == '2025-05-03'
+    assert user_info['name'] == '小美'
+    # 第二次讀取只取對話欄位
+    assert firebase.reads[-1][1] is not None
+
+def test_cached_profile_does_not_keep_conversation_fields():
+    firebase = FakeFirebase()
+    firebase.users['u1'] = {'name': '小美', 'state': 'booking_ask_date'}
+    service = UserService(firebase)
+
+    service.get_user_info('u1')
+    service.update_user_info('u1', {'name': '小美美', 'state': 'booking_ask_time'})
+    assert service.cache.peek('u1') == {'name': '小美美'}
+
+def test_merge_does_not_modify_entry_held_by_readers():
+    firebase = FakeFirebase()
+    firebase.users['u1'] = {'name': '小美', 'favorite_services': []}
+    service = UserService(firebase)
+
+    service.get_user_info('u1')
+    held = service.cache.peek('u1')
+    service.update_user_info('u1', {'favorite_services': ['凝膠美甲']})
+    assert held == {'name': '小美', 'favorite_services': []}
+    assert service.cache.peek('u1')['favorite_services'] == ['凝膠美甲']